@@ -2,7 +2,7 @@ import os
 from flask import Flask, render_template, request, g, redirect, url_for
 from werkzeug.exceptions import HTTPException
 from app.auth import login_required
-from . import database, auth, corr, mercati, ocr
+from . import database, auth, corr, importa, mercati, analisi, ocr, bench, model_server
 
 def create_app():
   # create and configure the app
@@ -17,10 +17,12 @@ def create_app():
     pass
 
   db = database.init_db(app)
+  ocr.init_app(app)
 
   app.register_blueprint(auth.bp)
   app.register_blueprint(corr.bp)
   app.register_blueprint(mercati.bp)
+  app.register_blueprint(analisi.bp)
   app.register_blueprint(ocr.bp)
   
   @app.route('/')
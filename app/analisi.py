@@ -0,0 +1,276 @@
+import datetime
+import re
+from collections import defaultdict
+from decimal import Decimal
+import click
+from flask import Blueprint, request
+from sqlalchemy import event, func, case, inspect
+from sqlalchemy.dialects.sqlite import insert
+from app.auth import login_required, admin_required
+from app.database import db, Corrispettivi, Vendite
+from app.parser import REPARTI
+
+# analisi delle vendite dalla tabella Vendite, che tiene i totali di ogni
+# reparto già sommati per giorno, settimana, mese e anno. La tabella viene
+# aggiornata in modo incrementale: ogni corrispettivo inserito, modificato o
+# eliminato somma (o sottrae) i propri valori alle righe dei suoi periodi con
+# un upsert, quindi le interrogazioni leggono al più una riga per periodo,
+# mercato e reparto, qualunque sia la quantità di storico
+
+bp = Blueprint('analisi', __name__, url_prefix='/analisi')
+
+GRANULARITA = ('giorno', 'settimana', 'mese', 'anno')
+COLONNE = [ 'data', 'mercato', 'giorno_mercato' ] + [ f'reparto{i}' for i in REPARTI ] + [ f'quantita{i}' for i in REPARTI ]
+# formato del periodo per ogni granularità
+FORMATI = {
+  'giorno': r'\d{4}-\d{2}-\d{2}',
+  'settimana': r'\d{4}-W\d{2}',
+  'mese': r'\d{4}-\d{2}',
+  'anno': r'\d{4}'
+}
+# corrispettivi letti per blocco durante la ricostruzione
+CHUNK_SIZE = 1000
+
+"""
+Aggiornamento
+"""
+
+# periodi a cui appartiene una data, per ogni granularità
+def periodi(data):
+  anno, settimana, _ = data.isocalendar()
+  return {
+    'giorno': data.isoformat(),
+    'settimana': f'{anno}-W{settimana:02}',
+    'mese': data.strftime('%Y-%m'),
+    'anno': str(data.year)
+  }
+
+# somma alla tabella Vendite i corrispettivi 'righe' e sottrae 'vecchie'
+# (dizionari con le colonne di COLONNE). Le righe vengono prima sommate in
+# memoria, così un blocco di corrispettivi dello stesso mese diventa una
+# sola riga per reparto e granularità
+def aggiorna(conn, righe, vecchie=()):
+  delta = defaultdict(lambda: [ Decimal(0), 0, 0 ])
+  for segno, gruppo in ((1, righe), (-1, vecchie)):
+    for riga in gruppo:
+      for granularita, periodo in periodi(riga['data']).items():
+        for i in REPARTI:
+          d = delta[(granularita, periodo, riga['mercato'], riga['giorno_mercato'], i)]
+          d[0] += segno * Decimal(str(riga[f'reparto{i}']))
+          d[1] += segno * int(riga[f'quantita{i}'])
+          d[2] += segno
+
+  values = [
+    { 'granularita': g, 'periodo': p, 'mercato': m, 'giorno_mercato': gm, 'reparto': r,
+      'totale': totale, 'quantita': quantita, 'corrispettivi': n }
+    for (g, p, m, gm, r), (totale, quantita, n) in delta.items()
+    if totale or quantita or n
+  ]
+  if not values:
+    return
+
+  table = Vendite.__table__
+  stmt = insert(table)
+  stmt = stmt.on_conflict_do_update(
+    index_elements=[ c.name for c in table.primary_key ],
+    set_={
+      'totale': table.c.totale + stmt.excluded.totale,
+      'quantita': table.c.quantita + stmt.excluded.quantita,
+      'corrispettivi': table.c.corrispettivi + stmt.excluded.corrispettivi
+    }
+  )
+  conn.execute(stmt, values)
+
+# colonne di un corrispettivo; con vecchi=True i valori prima delle modifiche non ancora salvate
+def valori(target, vecchi=False):
+  state = inspect(target)
+  riga = {}
+  for colonna in COLONNE:
+    value = getattr(target, colonna)
+    if vecchi:
+      history = state.attrs[colonna].history
+      if history.deleted:
+        value = history.deleted[0]
+    riga[colonna] = value
+  return riga
+
+# gli inserimenti dal form passano dalla sessione: gli eventi del mapper
+# aggiornano Vendite nella stessa transazione del corrispettivo. Gli insert in
+# blocco (app/importa.py) non generano questi eventi e chiamano aggiorna direttamente
+@event.listens_for(Corrispettivi, 'after_insert')
+def corrispettivo_inserito(mapper, connection, target):
+  aggiorna(connection, [ valori(target) ])
+
+@event.listens_for(Corrispettivi, 'after_update')
+def corrispettivo_modificato(mapper, connection, target):
+  aggiorna(connection, [ valori(target) ], [ valori(target, vecchi=True) ])
+
+@event.listens_for(Corrispettivi, 'after_delete')
+def corrispettivo_eliminato(mapper, connection, target):
+  aggiorna(connection, [], [ valori(target, vecchi=True) ])
+
+# ricalcola Vendite da zero, per i database creati prima della tabella
+@bp.cli.command('ricostruisci')
+def ricostruisci_command():
+  db.session.execute(db.delete(Vendite))
+  n = 0
+  rows = db.session.execute(db.select(*[ getattr(Corrispettivi, c) for c in COLONNE ])).mappings()
+  for chunk in rows.partitions(CHUNK_SIZE):
+    aggiorna(db.session.connection(), chunk)
+    n += len(chunk)
+  db.session.commit()
+  click.echo(f'{n} corrispettivi sommati.')
+
+"""
+API
+"""
+
+# vendite per periodo, sommate sulle dimensioni non richieste in 'per'.
+#   /analisi/vendite?granularita=mese&da=2024-01&a=2024-12&per=mercato,reparto
+# Filtri facoltativi: mercato, giorno_mercato, reparto
+@bp.get('/vendite')
+@login_required
+@admin_required
+def vendite():
+  granularita = request.args.get('granularita', 'mese')
+  error = check_periodo(granularita, request.args.get('da'), request.args.get('a'))
+  if error:
+    return { 'message': error }, 400
+
+  per = [ p for p in request.args.get('per', 'mercato').split(',') if p ]
+  if any(p not in ('mercato', 'giorno_mercato', 'reparto') for p in per):
+    return { 'message': 'Raggruppamento non valido' }, 400
+
+  reparto = request.args.get('reparto', type=int)
+  filtri = filtro(granularita, request.args.get('da'), request.args.get('a'))
+  for colonna in ('mercato', 'giorno_mercato'):
+    if request.args.get(colonna):
+      filtri.append(getattr(Vendite, colonna) == request.args[colonna])
+  if reparto:
+    filtri.append(Vendite.reparto == reparto)
+
+  colonne = [ Vendite.periodo ] + [ getattr(Vendite, p) for p in per ]
+  rows = db.session.execute(
+    db.select(*colonne, *somme(per_reparto='reparto' in per or reparto))
+      .where(*filtri)
+      .group_by(*colonne)
+      .order_by(*colonne)
+  ).mappings()
+
+  return {
+    'granularita': granularita,
+    'righe': [ formatta(row) for row in rows ]
+  }
+
+# totali di ogni mercato in un anno e in quello precedente.
+#   /analisi/confronto?anno=2025&fino_al=06
+# Con 'fino_al' si confrontano solo i mesi fino a quello indicato, ad
+# esempio per confrontare l'anno in corso con lo stesso periodo dell'anno prima
+@bp.get('/confronto')
+@login_required
+@admin_required
+def confronto():
+  anno = request.args.get('anno', datetime.date.today().year, type=int)
+  fino_al = request.args.get('fino_al')
+  if fino_al and not re.fullmatch(r'(0[1-9]|1[0-2])', fino_al):
+    return { 'message': 'Mese non valido' }, 400
+
+  totali = {}
+  for a in (anno - 1, anno):
+    if fino_al:
+      filtri = filtro('mese', f'{a}-01', f'{a}-{fino_al}')
+    else:
+      filtri = filtro('anno', str(a), str(a))
+    rows = db.session.execute(
+      db.select(Vendite.mercato, Vendite.giorno_mercato, *somme())
+        .where(*filtri)
+        .group_by(Vendite.mercato, Vendite.giorno_mercato)
+    ).mappings()
+    for row in rows:
+      totali.setdefault((row['mercato'], row['giorno_mercato']), {})[a] = formatta(row)
+
+  mercati = []
+  for (mercato, giorno), anni in sorted(totali.items()):
+    attuale = anni.get(anno, {}).get('totale', 0)
+    precedente = anni.get(anno - 1, {}).get('totale', 0)
+    mercati.append({
+      'mercato': mercato,
+      'giorno_mercato': giorno,
+      'anno': anni.get(anno),
+      'anno_precedente': anni.get(anno - 1),
+      'variazione': round((attuale - precedente) / precedente, 4) if precedente else None
+    })
+
+  return {
+    'anno': anno,
+    'fino_al': fino_al,
+    'mercati': mercati
+  }
+
+# composizione delle vendite per reparto in ogni giorno della settimana.
+#   /analisi/reparti?granularita=mese&da=2024-01&a=2024-12
+@bp.get('/reparti')
+@login_required
+@admin_required
+def reparti():
+  granularita = request.args.get('granularita', 'anno')
+  anno = str(datetime.date.today().year)
+  da = request.args.get('da', anno if granularita == 'anno' else None)
+  a = request.args.get('a', da)
+  error = check_periodo(granularita, da, a)
+  if error:
+    return { 'message': error }, 400
+
+  rows = db.session.execute(
+    db.select(Vendite.giorno_mercato, Vendite.reparto, *somme(per_reparto=True))
+      .where(*filtro(granularita, da, a))
+      .group_by(Vendite.giorno_mercato, Vendite.reparto)
+      .order_by(Vendite.giorno_mercato, Vendite.reparto)
+  ).mappings()
+
+  giorni = {}
+  for row in rows:
+    giorni.setdefault(row['giorno_mercato'], []).append(formatta(row))
+  for righe in giorni.values():
+    totale = sum(r['totale'] for r in righe)
+    for r in righe:
+      r['quota'] = round(r['totale'] / totale, 4) if totale else None
+
+  return {
+    'granularita': granularita,
+    'da': da,
+    'a': a,
+    'giorni': [ { 'giorno_mercato': giorno, 'reparti': righe } for giorno, righe in giorni.items() ]
+  }
+
+def check_periodo(granularita, da, a):
+  if granularita not in GRANULARITA:
+    return 'Granularità non valida'
+  for periodo in (da, a):
+    if periodo and not re.fullmatch(FORMATI[granularita], periodo):
+      return f'Periodo non valido per la granularità {granularita}: {periodo}'
+  return None
+
+# i periodi della stessa granularità sono ordinati anche come stringhe
+def filtro(granularita, da, a):
+  filtri = [ Vendite.granularita == granularita ]
+  if da:
+    filtri.append(Vendite.periodo >= da)
+  if a:
+    filtri.append(Vendite.periodo <= a)
+  return filtri
+
+# ogni corrispettivo compare in tutti e cinque i reparti: se non si
+# raggruppa per reparto lo si conta una volta sola, sulle righe del reparto 1
+def somme(per_reparto=False):
+  corrispettivi = Vendite.corrispettivi if per_reparto else case((Vendite.reparto == 1, Vendite.corrispettivi), else_=0)
+  return (
+    func.sum(Vendite.totale).label('totale'),
+    func.sum(Vendite.quantita).label('quantita'),
+    func.sum(corrispettivi).label('corrispettivi')
+  )
+
+def formatta(row):
+  row = dict(row)
+  row['totale'] = round(float(row['totale'] or 0), 2)
+  return row
@@ -0,0 +1,170 @@
+import ipaddress
+import logging
+import os
+import threading
+from multiprocessing.connection import Client
+
+logger = logging.getLogger(__name__)
+
+# motori di riconoscimento utilizzabili da app.inference. Ogni backend
+# espone lo stesso sottoinsieme dell'API di easyocr.Reader usato dalla
+# pipeline: readtext, readtext_batched, detect e recognize
+
+# easyocr.Reader con le impostazioni predefinite, come prima dei backend:
+# sulla CPU easyocr quantizza già dinamicamente a int8 i layer LSTM e
+# lineari di rilevatore e riconoscitore. È il riferimento del benchmark
+class TorchBackend:
+  name = 'torch'
+
+  def __init__(self, langs, device, options):
+    import easyocr
+    self.device = device
+    self.reader = easyocr.Reader(langs, gpu=device == 'cuda')
+
+  def readtext(self, img, **kwargs):
+    return self.reader.readtext(img, **kwargs)
+
+  def readtext_batched(self, imgs, **kwargs):
+    return self.reader.readtext_batched(imgs, **kwargs)
+
+  def detect(self, img, **kwargs):
+    return self.reader.detect(img, **kwargs)
+
+  def recognize(self, img, **kwargs):
+    return self.reader.recognize(img, **kwargs)
+
+# backend per i server senza GPU: gli stessi modelli di TorchBackend (la
+# quantizzazione è quella di easyocr), in più il numero di thread di torch
+# fissato e, se onnxruntime è installato e 'onnx' è attivo, il rilevatore
+# CRAFT esportato in ONNX ed eseguito in float32 con onnxruntime. Se
+# l'esportazione fallisce resta il modello torch
+class CpuBackend(TorchBackend):
+  name = 'cpu'
+
+  def __init__(self, langs, device, options):
+    import torch
+    if options.get('threads'):
+      torch.set_num_threads(options['threads'])
+
+    super().__init__(langs, 'cpu', options)
+
+    if options.get('onnx'):
+      try:
+        self.reader.detector = OnnxDetector.load(self.reader.detector, options['onnx_dir'])
+      except Exception:
+        logger.exception('rilevatore ONNX non disponibile, uso il modello torch')
+
+# sostituisce il modulo torch del rilevatore: easyocr lo chiama con un
+# tensore (batch, 3, h, w) e si aspetta la coppia (mappe, feature)
+class OnnxDetector:
+  def __init__(self, session):
+    self.session = session
+    self.input = session.get_inputs()[0].name
+
+  @classmethod
+  def load(cls, detector, directory):
+    import onnxruntime
+    import torch
+
+    path = os.path.join(directory, 'craft.onnx')
+    if not os.path.exists(path):
+      os.makedirs(directory, exist_ok=True)
+      dummy = torch.zeros(1, 3, 640, 480)
+      torch.onnx.export(
+        detector, dummy, path,
+        input_names=['image'], output_names=['y', 'feature'],
+        dynamic_axes={ 'image': { 0: 'batch', 2: 'height', 3: 'width' } })
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return cls(onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider']))
+
+  def __call__(self, x):
+    import torch
+    y, feature = self.session.run(None, { self.input: x.cpu().numpy() })
+    return torch.from_numpy(y), torch.from_numpy(feature)
+
+  def eval(self):
+    return self
+
+class RemoteInferenceError(Exception):
+  pass
+
+# inoltra le chiamate al processo di inferenza dedicato avviato con
+# 'flask ocr serve-model': i worker non caricano il modello. Ogni thread
+# usa una propria connessione
+class RemoteBackend:
+  name = 'remote'
+
+  def __init__(self, langs, device, options):
+    self.address = parse_address(options['address'])
+    self.authkey = options['authkey']
+    self.local = threading.local()
+
+  def _call(self, method, *args, **kwargs):
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = self.local.conn = Client(self.address, authkey=self.authkey)
+    try:
+      conn.send((method, args, kwargs))
+      status, result = conn.recv()
+    except (OSError, EOFError):
+      # connessione caduta (es. server riavviato): la prossima chiamata si riconnette
+      self.local.conn = None
+      conn.close()
+      raise
+    if status != 'ok':
+      raise RemoteInferenceError(result)
+    return result
+
+  def readtext(self, img, **kwargs):
+    return self._call('readtext', img, **kwargs)
+
+  def readtext_batched(self, imgs, **kwargs):
+    return self._call('readtext_batched', imgs, **kwargs)
+
+  def detect(self, img, **kwargs):
+    return self._call('detect', img, **kwargs)
+
+  def recognize(self, img, **kwargs):
+    return self._call('recognize', img, **kwargs)
+
+# lunghezza minima della chiave condivisa tra worker e processo di inferenza
+MIN_AUTHKEY_LENGTH = 16
+
+# il protocollo tra worker e processo di inferenza è multiprocessing.connection,
+# che scambia oggetti con pickle: chi si connette con la chiave giusta può
+# eseguire codice nel processo. Servono quindi una chiave esplicita, non
+# quella di sviluppo, e un indirizzo raggiungibile solo dalla macchina
+# stessa: un socket Unix o TCP su loopback. Solleva ValueError altrimenti
+def check_remote(address, authkey):
+  if not authkey or authkey == 'dev' or len(authkey) < MIN_AUTHKEY_LENGTH:
+    raise ValueError(
+      f'OCR_INFERENCE_AUTHKEY deve essere una chiave casuale di almeno {MIN_AUTHKEY_LENGTH} caratteri, '
+      'ad esempio python -c "import secrets; print(secrets.token_hex(32))".')
+
+  address = parse_address(address)
+  if isinstance(address, tuple) and not is_loopback(address[0]):
+    raise ValueError(
+      f'OCR_INFERENCE_ADDRESS accetta solo un socket Unix o un indirizzo di loopback, non {address[0] or "tutte le interfacce"}.')
+
+def is_loopback(host):
+  if host == 'localhost':
+    return True
+  try:
+    return ipaddress.ip_address(host.strip('[]')).is_loopback
+  except ValueError:
+    return False
+
+# 'host:porta' per TCP, altrimenti il percorso di un socket Unix
+def parse_address(address):
+  host, sep, port = address.rpartition(':')
+  if sep and port.isdigit():
+    return (host, int(port))
+  return address
+
+BACKENDS = {
+  TorchBackend.name: TorchBackend,
+  CpuBackend.name: CpuBackend,
+  RemoteBackend.name: RemoteBackend
+}
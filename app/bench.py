@@ -0,0 +1,282 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import click
+from flask import current_app
+from app import backends, inference, metrics
+from app.ocr import bp, read_receipt, CASSE
+from app.parser import CAMPI
+
+# benchmark della pipeline OCR su una cartella di foto di scontrini.
+# Per ogni immagine <nome>.jpeg la verità di riferimento è in <nome>.json,
+# con gli stessi campi ritornati da /ocr/ (data, reparto1..5, quantita1..5,
+# totale, quantita_totale). Esempio:
+#
+#   flask ocr bench instance/test-set -o instance/bench.json
+#   flask ocr bench instance/test-set --baseline instance/bench.json
+#
+# Per confrontare i backend sulle stesse immagini (easyocr predefinito
+# contro thread fissati e rilevatore ONNX):
+#
+#   flask ocr bench instance/test-set --cpu --backend torch -o instance/torch.json
+#   flask ocr bench instance/test-set --cpu --backend cpu --baseline instance/torch.json
+#
+# Per confrontare la lettura a strisce con quella dell'immagine intera
+# (il report mostra a parte gli scontrini lunghi):
+#
+#   flask ocr bench instance/test-set --no-tiling -o instance/single.json
+#   flask ocr bench instance/test-set --tiling --baseline instance/single.json
+#
+# Con OCR_LAYOUTS attivo, --cassa usa e aggiorna il modello di layout della
+# cassa: dalla seconda esecuzione si misurano le letture senza rilevamento
+#
+#   flask ocr bench instance/test-set --cassa 'Cassa 1' --repeat 4
+#
+# Il report mostra anche le misure di qualità delle foto lette bene e di
+# quelle lette male, per scegliere le soglie OCR_QUALITY_*: conviene
+# includere nel test set anche foto sfocate, scure o troppo lontane
+#
+# Il comando loadtest misura invece il throughput con più richieste
+# contemporanee, con e senza micro-batching:
+#
+#   flask ocr loadtest instance/test-set -c 8 -n 64 --microbatch
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.webp')
+STAGES = [ 'decode', 'blur', 'gain', 'crop', 'quality', 'layout', 'readtext', 'parse', 'recognize' ]
+
+@bp.cli.command('bench')
+@click.argument('folder', type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.option('-o', '--output', type=click.Path(dir_okay=False, path_type=Path),
+              help='File JSON in cui salvare i risultati, da usare come baseline.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False, path_type=Path),
+              help='Risultati di riferimento: il comando fallisce se si peggiora.')
+@click.option('--max-slowdown', default=0.1, show_default=True,
+              help='Aumento relativo massimo tollerato della latenza p95.')
+@click.option('--max-accuracy-drop', default=0.0, show_default=True,
+              help='Calo massimo tollerato dell\'accuratezza di un campo.')
+@click.option('--repeat', default=1, show_default=True, help='Letture per immagine.')
+@click.option('--backend', type=click.Choice(sorted(backends.BACKENDS)),
+              help='Backend CPU da usare al posto di OCR_BACKEND.')
+@click.option('--cpu', is_flag=True, help='Legge solo con la CPU, anche se c\'è una GPU.')
+@click.option('--cassa', type=click.Choice(CASSE),
+              help='Cassa degli scontrini, per usare e aggiornare il suo modello di layout.')
+@click.option('--tiling/--no-tiling', default=None,
+              help='Forza la lettura a strisce degli scontrini lunghi, altrimenti vale OCR_TILING.')
+def bench(folder, output, baseline, max_slowdown, max_accuracy_drop, repeat, backend, cpu, cassa, tiling):
+  samples = load_samples(folder)
+  if not samples:
+    raise click.ClickException(f'Nessuna immagine con verità di riferimento in {folder}.')
+
+  if cpu:
+    inference.use_device('cpu')
+  if backend:
+    inference.use_backend(backend)
+  if tiling is not None:
+    current_app.config['OCR_TILING'] = tiling
+
+  # il caricamento del modello non fa parte delle misure
+  start = time.perf_counter()
+  inference.get_backend()
+  load_time = time.perf_counter() - start
+
+  runs = []
+  for path, truth in samples:
+    data = path.read_bytes()
+    for _ in range(repeat):
+      run = run_sample(data, truth, cassa)
+      run['image'] = path.name
+      runs.append(run)
+    click.echo(f"{path.name}: {run['latency'] * 1000:.0f} ms, "
+               f"{run['correct']}/{len(truth)} campi corretti")
+
+  report = summarize(runs)
+  report['model_load'] = load_time
+  report['backend'] = inference.status()['backend']
+  print_report(report)
+
+  if output:
+    output.write_text(json.dumps(report, indent=2))
+    click.echo(f'Risultati salvati in {output}')
+
+  if baseline:
+    errors = compare(report, json.loads(baseline.read_text()), max_slowdown, max_accuracy_drop)
+    if errors:
+      raise click.ClickException('Regressione rispetto alla baseline:\n  ' + '\n  '.join(errors))
+    click.echo('Nessuna regressione rispetto alla baseline.')
+
+def load_samples(folder):
+  samples = []
+  for path in sorted(folder.iterdir()):
+    truth = path.with_suffix('.json')
+    if path.suffix.lower() in IMAGE_SUFFIXES and truth.exists():
+      samples.append((path, json.loads(truth.read_text())))
+  return samples
+
+def run_sample(data, truth, cassa=None):
+  with metrics.collect() as trace:
+    start = time.perf_counter()
+    payload, code = read_receipt(data, cassa=cassa)
+    latency = time.perf_counter() - start
+
+  parsed = payload if code == 200 else {}
+  fields = { field: same_value(parsed.get(field), expected) for field, expected in truth.items() }
+
+  timings = {}
+  for name, elapsed in trace.stages:
+    timings[name] = timings.get(name, 0) + elapsed
+
+  return {
+    'latency': latency,
+    'code': code,
+    'fields': fields,
+    'correct': sum(fields.values()),
+    'stages': timings,
+    'inferences': sum(1 for name, _ in trace.stages if name == 'readtext'),
+    'branch': trace.attrs.get('branch'),
+    'tall': trace.attrs.get('tall', False),
+    'quality': trace.attrs.get('quality')
+  }
+
+def same_value(read, expected):
+  if read is None:
+    return False
+  if isinstance(expected, (int, float)):
+    try:
+      return abs(float(read) - expected) < 0.005
+    except (TypeError, ValueError):
+      return False
+  return str(read) == str(expected)
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def summarize(runs):
+  latencies = [ run['latency'] for run in runs ]
+  tall = [ run for run in runs if run['tall'] ]
+
+  accuracy = {}
+  for field in CAMPI:
+    checked = [ run['fields'][field] for run in runs if field in run['fields'] ]
+    if checked:
+      accuracy[field] = sum(checked) / len(checked)
+
+  stages = {}
+  for name in STAGES:
+    stages[name] = sum(run['stages'].get(name, 0) for run in runs) / len(runs)
+
+  return {
+    'images': len(runs),
+    'images_per_second': len(runs) / sum(latencies),
+    'latency': {
+      'mean': sum(latencies) / len(latencies),
+      'p50': percentile(latencies, 50),
+      'p95': percentile(latencies, 95)
+    },
+    'accuracy': accuracy,
+    'complete_reads': sum(1 for run in runs if all(run['fields'].values())) / len(runs),
+    'inferences_per_image': sum(run['inferences'] for run in runs) / len(runs),
+    'layout_reads': sum(1 for run in runs if run.get('branch') == 'layout') / len(runs),
+    'stages': stages,
+    # scontrini lunghi, quelli che con OCR_TILING vengono letti a strisce
+    'tall': {
+      'images': len(tall),
+      'p50': percentile([ run['latency'] for run in tall ], 50),
+      'p95': percentile([ run['latency'] for run in tall ], 95),
+      'accuracy': sum(run['correct'] / len(run['fields']) for run in tall if run['fields']) / len(tall)
+    } if tall else None,
+    'rejected': sum(1 for run in runs if run['code'] == 422),
+    'quality': quality_report(runs),
+    'runs': runs
+  }
+
+# distribuzione delle misure di qualità tra letture complete e non
+def quality_report(runs):
+  report = {}
+  for outcome, complete in (('complete', True), ('incomplete', False)):
+    measured = [ run['quality'] for run in runs
+                 if run['quality'] and bool(run['fields']) and all(run['fields'].values()) == complete ]
+    if measured:
+      report[outcome] = { name: { p: percentile([ q[name] for q in measured ], p) for p in (5, 50, 95) }
+                          for name in measured[0] }
+  return report
+
+def print_report(report):
+  latency = report['latency']
+  click.echo()
+  click.echo(f"Immagini: {report['images']}  ({report['images_per_second']:.2f} img/s)")
+  click.echo(f"Latenza: p50 {latency['p50'] * 1000:.0f} ms, p95 {latency['p95'] * 1000:.0f} ms")
+  click.echo(f"Inferenze per immagine: {report['inferences_per_image']:.2f}")
+  click.echo(f"Letture complete: {report['complete_reads']:.1%}")
+  click.echo(f"Letture con il modello di layout: {report['layout_reads']:.1%}")
+  if report['tall']:
+    tall = report['tall']
+    click.echo(f"Scontrini lunghi: {tall['images']}, latenza p50 {tall['p50'] * 1000:.0f} ms, "
+               f"p95 {tall['p95'] * 1000:.0f} ms, {tall['accuracy']:.1%} campi corretti")
+  click.echo(f"Foto scartate dal controllo di qualità: {report['rejected']}")
+  for outcome, measures in report['quality'].items():
+    click.echo(f'Qualità delle letture {outcome} (p5 / p50 / p95):')
+    for name, values in measures.items():
+      click.echo(f'  {name:<10} ' + ' / '.join(f'{v:.2f}' for v in values.values()))
+  click.echo('Tempi medi per fase:')
+  for name, elapsed in report['stages'].items():
+    click.echo(f'  {name:<10} {elapsed * 1000:8.1f} ms')
+  click.echo('Accuratezza per campo:')
+  for field, acc in report['accuracy'].items():
+    click.echo(f'  {field:<16} {acc:.1%}')
+
+def compare(report, baseline, max_slowdown, max_accuracy_drop):
+  errors = []
+  old_p95 = baseline['latency']['p95']
+  new_p95 = report['latency']['p95']
+  if new_p95 > old_p95 * (1 + max_slowdown):
+    errors.append(f'latenza p95 {new_p95 * 1000:.0f} ms, baseline {old_p95 * 1000:.0f} ms')
+
+  for field, old in baseline['accuracy'].items():
+    new = report['accuracy'].get(field, 0)
+    if new < old - max_accuracy_drop:
+      errors.append(f'accuratezza di {field} {new:.1%}, baseline {old:.1%}')
+  return errors
+
+@bp.cli.command('loadtest')
+@click.argument('folder', type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.option('-c', '--concurrency', default=4, show_default=True, help='Richieste contemporanee.')
+@click.option('-n', '--requests', 'total', default=32, show_default=True, help='Richieste totali.')
+@click.option('--microbatch/--no-microbatch', default=None,
+              help='Forza il micro-batching, altrimenti vale OCR_MICROBATCH.')
+def loadtest(folder, concurrency, total, microbatch):
+  images = [ path.read_bytes() for path in sorted(folder.iterdir())
+             if path.suffix.lower() in IMAGE_SUFFIXES ]
+  if not images:
+    raise click.ClickException(f'Nessuna immagine in {folder}.')
+
+  config = current_app.config
+  if microbatch is None:
+    microbatch = config['OCR_MICROBATCH']
+  if microbatch:
+    inference.start_batcher(config['OCR_MICROBATCH_WINDOW'], config['OCR_MICROBATCH_MAX'])
+  else:
+    inference.stop_batcher()
+
+  inference.get_backend()
+  app = current_app._get_current_object()
+
+  def request(i):
+    with app.app_context():
+      start = time.perf_counter()
+      read_receipt(images[i % len(images)])
+      return time.perf_counter() - start
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    latencies = list(executor.map(request, range(total)))
+  elapsed = time.perf_counter() - start
+
+  batch = metrics.snapshot()['observations'].get('ocr_microbatch_size')
+  click.echo(f"Micro-batching: {'attivo' if microbatch else 'disattivo'}, {concurrency} richieste contemporanee")
+  click.echo(f'Throughput: {total / elapsed:.2f} img/s')
+  click.echo(f'Latenza: p50 {percentile(latencies, 50) * 1000:.0f} ms, '
+             f'p95 {percentile(latencies, 95) * 1000:.0f} ms')
+  if batch:
+    click.echo(f"Dimensione media dei batch: {batch['avg']:.2f}")
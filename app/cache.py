@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from app import metrics
+
+# cache LRU dei risultati OCR, indicizzata sull'hash dei byte caricati.
+# Le voci scadono dopo 'ttl' secondi; se 'path' è impostato la cache viene
+# salvata su disco e ricaricata al riavvio, a meno che nel frattempo sia
+# cambiata la versione del parser o del modello
+class ResultCache:
+  def __init__(self, max_size, ttl, version, path=None):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.version = version
+    self.path = path
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    if path:
+      self._load()
+
+  @staticmethod
+  def key(data):
+    return hashlib.sha256(data).hexdigest()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and time.time() - entry[0] > self.ttl:
+        del self.entries[key]
+        entry = None
+
+      if entry is None:
+        metrics.incr('ocr_cache_misses_total')
+        return None
+
+      self.entries.move_to_end(key)
+      metrics.incr('ocr_cache_hits_total')
+      return dict(entry[1])
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = (time.time(), dict(value))
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+        metrics.incr('ocr_cache_evictions_total')
+      metrics.set_gauge('ocr_cache_entries', len(self.entries))
+      if self.path:
+        self._save()
+
+  def _load(self):
+    try:
+      with open(self.path) as f:
+        stored = json.load(f)
+    except (OSError, ValueError):
+      return
+
+    # parser o modello cambiati: i risultati salvati non valgono più
+    if stored.get('version') != self.version:
+      return
+
+    now = time.time()
+    for key, ts, value in stored.get('entries', [])[-self.max_size:]:
+      if now - ts <= self.ttl:
+        self.entries[key] = (ts, value)
+    metrics.set_gauge('ocr_cache_entries', len(self.entries))
+
+  def _save(self):
+    tmp = self.path + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        json.dump({
+          'version': self.version,
+          'entries': [ [key, ts, value] for key, (ts, value) in self.entries.items() ]
+        }, f)
+      os.replace(tmp, self.path)
+    except OSError:
+      metrics.incr('ocr_cache_save_errors_total')
@@ -9,15 +9,21 @@ import re
 import decimal
 
 from app.auth import login_required
+from app.parser import CAMPI, REPARTI
 
 bp = Blueprint('corr', __name__, url_prefix='/corr')
 
+GIORNI = [ 'Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì', 'Sabato', 'Domenica' ]
+
+def mercati_attivi():
+  return list(db.session.scalars(db.select(Mercati).where(or_(Mercati.is_attuale==True, Mercati.is_evento==True))))
+
 @bp.route('/', methods=('GET', 'POST'))
 @login_required
 def inserisci():
   # Va castato a list perché scalars ritorna un iteratore che consuma i dati quando ci iteri sopra, quindi non posso
   # iterarci due volte senza rifare la query
-  mercati = list(db.session.scalars(db.select(Mercati).where(or_(Mercati.is_attuale==True, Mercati.is_evento==True))))
+  mercati = mercati_attivi()
   mercati_nomi = set([ mercato.nome for mercato in mercati ])
   mercati_dict = [ { 'mercato': mercato.nome, 'giorno': mercato.giorno } for mercato in mercati ]
 
@@ -156,11 +162,8 @@ def validate_input(req, mercati):
       error['totale'] = 'Il totale non può essere negativo.'
     
     if somma_reparti != rep_totale:
-      error['reparto1'] = error['reparto1'] if 'reparto1' in error else ''
-      error['reparto2'] = error['reparto2'] if 'reparto2' in error else ''
-      error['reparto3'] = error['reparto3'] if 'reparto3' in error else ''
-      error['reparto4'] = error['reparto4'] if 'reparto4' in error else ''
-      error['reparto5'] = error['reparto5'] if 'reparto5' in error else ''
+      for i in REPARTI:
+        error.setdefault(f'reparto{i}', '')
       error['totale'] = 'La somma dei reparti non coincide col totale.'
   
   except Exception as e:
@@ -174,11 +177,8 @@ def validate_input(req, mercati):
       error['q_totale'] = 'Il n. pezzi non può essere negativo.'
     
     if somma_quantita != q_totale:
-      error['quantita1'] = error['quantita1'] if 'quantita1' in error else ''
-      error['quantita2'] = error['quantita2'] if 'quantita2' in error else ''
-      error['quantita3'] = error['quantita3'] if 'quantita3' in error else ''
-      error['quantita4'] = error['quantita4'] if 'quantita4' in error else ''
-      error['quantita5'] = error['quantita5'] if 'quantita5' in error else ''
+      for i in REPARTI:
+        error.setdefault(f'quantita{i}', '')
       error['quantita_totale'] = 'La somma delle quantità dei reparti non coincide col n. pezzi.'
   
   except:
@@ -189,6 +189,29 @@ def validate_input(req, mercati):
 
   return error, corrispettivo
 
+# bozza di corrispettivo da una lettura OCR. Il mercato viene indovinato
+# dal giorno della settimana della data letta tra i mercati attivi
+# ('mercati' come quelli passati al template, { 'mercato', 'giorno' }):
+# se quel giorno ce n'è più di uno restano tutti tra i candidati
+def bozza(parsed, mercati, cassa=None):
+  draft = { campo: parsed.get(campo) for campo in CAMPI }
+  draft['cassa'] = cassa
+  draft['giorno_mercato'] = None
+  draft['mercato'] = None
+  candidati = []
+
+  try:
+    data = datetime.datetime.strptime(parsed['data'], '%Y-%m-%d').date()
+    draft['giorno_mercato'] = GIORNI[data.weekday()]
+    candidati = sorted(m['mercato'] for m in mercati if m['giorno'] == draft['giorno_mercato'])
+  except (KeyError, TypeError, ValueError):
+    pass
+
+  if len(candidati) == 1:
+    draft['mercato'] = candidati[0]
+  draft['candidati'] = candidati
+  return draft
+
 @bp.route('/success')
 @login_required
 def success():
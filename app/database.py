@@ -132,6 +132,40 @@ class Corrispettivi(db.Model):
     )
   )
 
+# Vendite: totali e quantità di ogni reparto pre-aggregati per periodo e
+# mercato, aggiornati a ogni inserimento o modifica dei corrispettivi (vedi
+# app/analisi.py). Il periodo è la data ('2024-05-04'), la settimana ISO
+# ('2024-W18'), il mese ('2024-05') o l'anno ('2024'), a seconda della granularità
+
+Granularita = Literal['giorno', 'settimana', 'mese', 'anno']
+
+class Vendite(db.Model):
+  __tablename__ = 'Vendite'
+
+  granularita: Mapped[Granularita] = mapped_column(primary_key=True)
+  periodo: Mapped[str] = mapped_column(primary_key=True)
+  mercato: Mapped[str] = mapped_column(primary_key=True)
+  giorno_mercato: Mapped[Giorno] = mapped_column(primary_key=True)
+  reparto: Mapped[int] = mapped_column(primary_key=True)
+  totale: Mapped[Decimal] = mapped_column(Numeric(12, 2))
+  quantita: Mapped[int]
+  corrispettivi: Mapped[int]
+
+  __table_args__ = (
+    ForeignKeyConstraint(
+      ['mercato', 'giorno_mercato'], ['Mercati.nome', 'Mercati.giorno'],
+      onupdate='CASCADE'
+    ),
+    CheckConstraint(
+      "granularita IN ('giorno', 'settimana', 'mese', 'anno')",
+      name='granularita_dominio'
+    ),
+    CheckConstraint(
+      'reparto BETWEEN 1 AND 5',
+      name='reparto_dominio'
+    )
+  )
+
 def init_db(app):
   db.init_app(app)
 
@@ -0,0 +1,184 @@
+import logging
+import cv2
+import numpy as np
+from flask import current_app
+from app import inference, metrics
+from app.parser import FIELDS, keywords, match_keyword, get_rep, parse_int, parse_float
+
+# rilettura mirata dei campi mancanti o letti con poca confidenza. Dai box
+# di readtext(detail=1) si ritrovano le parole chiave ('Reparto n',
+# 'Quantità', 'Totale', 'Pezzi') e, sulla stessa riga alla loro destra, la
+# regione dove si trova il valore. Le regioni vengono ingrandite,
+# ricontrastate e impilate in un'unica immagine che viene letta con una sola
+# chiamata al riconoscitore, senza rifare il rilevamento su tutto lo scontrino.
+# Le regioni contengono solo numeri, quindi con OCR_FIELD_PROFILES vengono
+# lette con il profilo del campo: caratteri ammessi ristretti e decodifica greedy
+
+logger = logging.getLogger(__name__)
+
+# margine attorno alla riga, in frazioni dell'altezza del box della parola chiave
+LINE_MARGIN = 0.3
+# spazio bianco tra le regioni impilate
+GAP = 16
+
+# profili di riconoscimento: argomenti di recognize per tipo di valore
+PROFILES = {
+  'quantita': { 'allowlist': '0123456789', 'decoder': 'greedy' },
+  'importo': { 'allowlist': '0123456789,.-', 'decoder': 'greedy' },
+  'data': { 'allowlist': '0123456789-: ', 'decoder': 'greedy' }
+}
+
+def profile(field):
+  if field == 'data':
+    return 'data'
+  return 'quantita' if field.startswith('quantita') else 'importo'
+
+# confidenza del token da cui parse_ocr_result ha letto ogni campo
+def confidences(result, sources):
+  return { field: float(result[i][2]) for field, i in sources.items() }
+
+# rilegge i campi che mancano in 'parsed' o letti con confidenza bassa,
+# usando i box di 'result' (l'output di readtext(img, detail=1)). Ritorna i
+# campi riletti con successo e le loro confidenze, da unire a quelli già letti
+def repair(img, result, parsed, confidence):
+  config = current_app.config
+  min_confidence = config['OCR_FIELD_REPAIR_MIN_CONFIDENCE']
+
+  targets = []
+  for field, (keyword, value) in locate(result).items():
+    old = confidence.get(field, 0) if field in parsed else 0
+    if old >= min_confidence:
+      continue
+    x0, x1, y0, y1 = rect = region(result, keyword, value, img.shape)
+    if x1 - x0 > 4 and y1 - y0 > 4:
+      targets.append((field, old, rect))
+
+  if not targets:
+    return {}, {}
+  metrics.incr('ocr_field_repair_regions_total', len(targets))
+
+  # con i profili serve una chiamata per profilo, perché allowlist vale per tutta l'immagine
+  groups = {}
+  for target in targets:
+    key = profile(target[0]) if config['OCR_FIELD_PROFILES'] else None
+    groups.setdefault(key, []).append(target)
+
+  gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+  repaired = {}
+  repaired_confidence = {}
+  for key, group in groups.items():
+    crops = [ gray[y0:y1, x0:x1] for _, _, (x0, x1, y0, y1) in group ]
+    canvas, boxes = stack(crops, config['OCR_FIELD_REPAIR_SCALE'])
+    with metrics.stage('recognize'):
+      read = inference.recognize(canvas, horizontal_list=boxes, free_list=[], detail=1,
+                                 **PROFILES.get(key, {}))
+
+    for (field, old, _), (text, new) in zip(group, assign(read, boxes)):
+      # teniamo la nuova lettura solo se è più sicura di quella che sostituisce
+      if text is None or new <= old:
+        continue
+      text = ''.join(c for c in text if c.isdigit() or c in ',.')
+      value = parse_int(text) if profile(field) == 'quantita' else parse_float(text)
+      if value > 0:
+        repaired[field] = value
+        repaired_confidence[field] = float(new)
+        metrics.incr('ocr_field_repaired_total', field=field)
+
+  logger.debug('campi riletti: %s', repaired)
+  return repaired, repaired_confidence
+
+# associa le parole chiave ai campi seguendo le stesse regole di
+# parse_ocr_result. Ritorna per ogni campo l'indice del box della parola
+# chiave e quello del box del valore, o None se il valore non è stato rilevato
+def locate(result):
+  words = [ ' '.join(text.lower().split()) for _, text, _ in result ]
+  found = {}
+  current_rep = None
+  i = 0
+  while i < len(words):
+    word = words[i]
+    nxt = words[i+1] if i+1 < len(words) else None
+    keyword = match_keyword(word)
+
+    field = None
+    if keyword == 'reparto' and nxt and 'totale' in keywords(nxt):
+      # 'reparto' 'totale' in due box: il valore segue 'totale'
+      i += 1
+      field = 'totale'
+    elif keyword == 'reparto totale':
+      field = 'totale'
+    elif keyword == 'reparto':
+      n = get_rep(word, nxt)
+      if n > 0:
+        current_rep = n
+      elif current_rep:
+        current_rep += 1
+    elif keyword == 'quantita' and current_rep:
+      field = f'quantita{current_rep}'
+    elif keyword == 'totale' and current_rep:
+      field = f'reparto{current_rep}'
+    elif keyword == 'pezzi':
+      field = 'quantita_totale'
+
+    if field in FIELDS and field not in found:
+      found[field] = (i, value_index(result, i))
+    i += 1
+  return found
+
+# il valore è il box successivo, se sta sulla stessa riga a destra della parola chiave
+def value_index(result, keyword):
+  if keyword + 1 >= len(result):
+    return None
+  kx0, kx1, ky0, ky1 = bounds(result[keyword][0])
+  vx0, _, vy0, vy1 = bounds(result[keyword + 1][0])
+  if ky0 <= (vy0 + vy1) / 2 <= ky1 and vx0 >= (kx0 + kx1) / 2:
+    return keyword + 1
+  return None
+
+def bounds(box):
+  xs = [ p[0] for p in box ]
+  ys = [ p[1] for p in box ]
+  return min(xs), max(xs), min(ys), max(ys)
+
+# regione (x0, x1, y0, y1) in cui rileggere il valore: il box del valore
+# allargato, o se manca il resto della riga a destra della parola chiave
+def region(result, keyword, value, shape):
+  h, w = shape[:2]
+  x0, x1, y0, y1 = bounds(result[keyword][0])
+  margin = int((y1 - y0) * LINE_MARGIN)
+  if value is not None:
+    x0, x1, vy0, vy1 = bounds(result[value][0])
+    x0, x1 = x0 - margin, x1 + margin
+    y0, y1 = min(y0, vy0), max(y1, vy1)
+  else:
+    x0, x1 = x1, w
+  return max(0, int(x0)), min(w, int(x1)), max(0, int(y0) - margin), min(h, int(y1) + margin)
+
+# ingrandisce e ricontrasta le regioni e le impila su sfondo bianco.
+# Ritorna l'immagine e i box delle regioni nel formato di horizontal_list
+def stack(crops, scale):
+  crops = [ cv2.normalize(cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC),
+                          None, 0, 255, cv2.NORM_MINMAX) for crop in crops ]
+  width = max(crop.shape[1] for crop in crops) + 2 * GAP
+  height = sum(crop.shape[0] for crop in crops) + GAP * (len(crops) + 1)
+  canvas = np.full((height, width), 255, np.uint8)
+
+  boxes = []
+  y = GAP
+  for crop in crops:
+    h, w = crop.shape
+    canvas[y:y+h, GAP:GAP+w] = crop
+    boxes.append([GAP, GAP + w, y, y + h])
+    y += h + GAP
+  return canvas, boxes
+
+# per ogni box impilato, il testo letto più sicuro e la sua confidenza
+def assign(read, boxes):
+  texts = [ (None, 0) ] * len(boxes)
+  for box, text, confidence in read:
+    _, _, y0, y1 = bounds(box)
+    center = (y0 + y1) / 2
+    for i, (_, _, by0, by1) in enumerate(boxes):
+      if by0 <= center <= by1 and confidence > texts[i][1]:
+        texts[i] = (text, confidence)
+  return texts
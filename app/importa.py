@@ -0,0 +1,278 @@
+import csv
+import datetime
+import decimal
+import io
+import json
+import os
+import re
+import click
+from flask import render_template, request, g
+from sqlalchemy import exc
+from app import analisi
+from app.auth import login_required, admin_required
+from app.corr import bp, GIORNI
+from app.database import db, Mercati, Corrispettivi, Utenti
+from app.parser import REPARTI
+
+# importazione in blocco dei corrispettivi storici o arretrati da un file
+# CSV, JSON (lista di oggetti) o JSON Lines, con le stesse colonne del form
+# di inserimento: data, mercato, giorno_mercato, cassa, reparto1..5,
+# quantita1..5, totale, quantita_totale. Le righe vengono validate con le
+# stesse regole di corr.validate_input su un'unica copia in memoria dei
+# mercati e dei corrispettivi già presenti, e le righe valide vengono
+# inserite a blocchi, una transazione per blocco.
+#
+#   flask corr importa storico.csv --utente Dario
+#   flask corr importa storico.csv --utente Dario --prova
+#
+# Gli amministratori possono caricare lo stesso file da /corr/importa
+
+# righe inserite per transazione
+CHUNK_SIZE = 1000
+# errori mostrati nella pagina di importazione
+MAX_ERRORI_MOSTRATI = 200
+
+@bp.cli.command('importa')
+@click.argument('file', type=click.File('rb'))
+@click.option('--utente', required=True, help='Utente a cui attribuire l\'inserimento.')
+@click.option('--prova', is_flag=True, help='Valida il file senza inserire nulla.')
+def importa_command(file, utente, prova):
+  if db.session.get(Utenti, utente) is None:
+    raise click.ClickException(f'L\'utente {utente} non esiste.')
+
+  try:
+    report = importa(file, os.path.splitext(file.name)[1], utente, prova)
+  except ValueError as e:
+    raise click.ClickException(str(e))
+  for riga in report['errori']:
+    click.echo(f"riga {riga['riga']}: " + '; '.join(f'{k}: {v}' if v else k for k, v in riga['errori'].items()))
+  click.echo(f"{report['righe']} righe lette, {report['inserite']} inserite, "
+             f"{len(report['errori'])} con errori{' (prova, nessun inserimento)' if prova else ''}.")
+
+@bp.route('/importa', methods=('GET', 'POST'))
+@login_required
+@admin_required
+def importa_upload():
+  report = None
+  error = None
+  if request.method == 'POST':
+    f = request.files.get('file')
+    if not f or not f.filename:
+      error = 'Nessun file inviato.'
+    else:
+      try:
+        report = importa(f.stream, os.path.splitext(f.filename)[1], g.user.username, 'prova' in request.form)
+      except ValueError as e:
+        error = str(e)
+
+  return render_template('corr/importa.html',
+                         report=report,
+                         error=error,
+                         max_errori=MAX_ERRORI_MOSTRATI)
+
+# valida e inserisce le righe di 'stream' (binario). Ritorna il report con il
+# numero di righe lette e inserite e gli errori di ogni riga scartata
+def importa(stream, ext, utente, prova=False):
+  rows = read_rows(stream, ext.lower())
+
+  # un'unica query per i mercati e una per le chiavi già presenti: la
+  # validazione non tocca più il database. A differenza del form si accettano
+  # anche i mercati non più attuali, perché i dati storici li possono usare
+  mercati = { (m.nome, m.giorno) for m in db.session.scalars(db.select(Mercati)) }
+  esistenti = set(db.session.execute(db.select(Corrispettivi.data, Corrispettivi.mercato)).tuples())
+
+  now = datetime.datetime.now()
+  report = { 'righe': 0, 'inserite': 0, 'errori': [] }
+  chunk = []
+  for n, row in rows:
+    report['righe'] += 1
+    if not isinstance(row, dict):
+      report['errori'].append({ 'riga': n, 'errori': { 'riga': 'La riga non è un corrispettivo valido.' } })
+      continue
+    error, values = validate_row(row, mercati, now)
+
+    key = (values.get('data'), values.get('mercato'))
+    if not error and key in esistenti:
+      error['data'] = f"Esiste già un corrispettivo per il mercato {key[1]} svoltosi il {key[0].strftime('%d-%m-%Y')}."
+    if error:
+      report['errori'].append({ 'riga': n, 'errori': error })
+      continue
+
+    # anche due righe uguali nello stesso file sono un duplicato
+    esistenti.add(key)
+    values.update(ts=now, inserito_da=utente)
+    chunk.append((n, values))
+    if len(chunk) >= CHUNK_SIZE:
+      insert_chunk(chunk, report, prova)
+      chunk = []
+
+  if chunk:
+    insert_chunk(chunk, report, prova)
+  report['errori'].sort(key=lambda riga: riga['riga'])
+  return report
+
+# inserisce un blocco di righe con un'unica executemany. Se il blocco viola
+# un vincolo (es. un corrispettivo inserito nel frattempo dal form) lo si
+# ripete riga per riga, per riportare l'errore sulla riga giusta. Gli insert
+# in blocco non generano gli eventi dell'ORM: le vendite aggregate vengono
+# aggiornate esplicitamente, nella stessa transazione
+def insert_chunk(chunk, report, prova):
+  if prova:
+    report['inserite'] += len(chunk)
+    return
+
+  try:
+    rows = [ values for _, values in chunk ]
+    db.session.execute(db.insert(Corrispettivi), rows)
+    analisi.aggiorna(db.session.connection(), rows)
+    db.session.commit()
+    report['inserite'] += len(chunk)
+    return
+  except exc.IntegrityError:
+    db.session.rollback()
+
+  for n, values in chunk:
+    try:
+      db.session.execute(db.insert(Corrispettivi), [ values ])
+      analisi.aggiorna(db.session.connection(), [ values ])
+      db.session.commit()
+      report['inserite'] += 1
+    except exc.SQLAlchemyError as e:
+      db.session.rollback()
+      report['errori'].append({ 'riga': n, 'errori': { 'database': str(e.orig) if hasattr(e, 'orig') else str(e) } })
+
+# coppie (numero di riga, dizionario) lette una alla volta dal file. Gli
+# errori del file intero (formato, intestazione) sollevano ValueError prima
+# di qualunque inserimento; una riga illeggibile viene ritornata come None e
+# finisce nel report. I byte non UTF-8 diventano caratteri non validi, che
+# la validazione scarta, invece di interrompere la lettura a metà
+def read_rows(stream, ext):
+  if ext == '.csv':
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    first = text.readline()
+    if not first.strip():
+      raise ValueError('Il file è vuoto.')
+    # i CSV esportati da Excel in italiano usano il punto e virgola
+    try:
+      dialect = csv.Sniffer().sniff(first, delimiters=',;\t')
+    except csv.Error:
+      # un'unica colonna: non c'è un separatore da indovinare
+      dialect = csv.excel
+    reader = csv.DictReader(text, fieldnames=next(csv.reader([ first ], dialect)), dialect=dialect)
+    # la riga 1 è l'intestazione
+    return ((n, row) for n, row in enumerate(reader, start=2))
+
+  if ext in ('.jsonl', '.ndjson'):
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+    return ((n, json_line(line)) for n, line in enumerate(text, start=1) if line.strip())
+
+  if ext == '.json':
+    try:
+      rows = json.load(stream)
+    except ValueError as e:
+      raise ValueError(f'Il file JSON non è valido: {e}')
+    if not isinstance(rows, list):
+      raise ValueError('Il file JSON deve contenere una lista di corrispettivi.')
+    return enumerate(rows, start=1)
+
+  raise ValueError('Formato non supportato: usa un file .csv, .json o .jsonl.')
+
+def json_line(line):
+  try:
+    return json.loads(line)
+  except ValueError:
+    return None
+
+# stesse regole di corr.validate_input, su un dizionario. Ritorna gli errori
+# (con le stesse chiavi e messaggi del form) e i valori da inserire
+def validate_row(row, mercati, now):
+  error = {}
+  values = {}
+  row = { k.strip(): (str(v).strip() if v is not None else '') for k, v in row.items() if k }
+
+  # data
+  try:
+    values['data'] = datetime.datetime.strptime(row.get('data', ''), '%Y-%m-%d').date()
+    if values['data'] > now.date():
+      error['data'] = 'La data non può essere successiva a oggi.'
+  except ValueError:
+    error['data'] = 'La data inserita non è valida.'
+
+  # giorno_mercato: se manca lo ricaviamo dalla data
+  giorno_mercato = row.get('giorno_mercato') or (GIORNI[values['data'].weekday()] if 'data' in values else '')
+  if giorno_mercato not in GIORNI:
+    error['giorno_mercato'] = 'Giorno della settimana non valido.'
+  elif 'data' in values and GIORNI[values['data'].weekday()] != giorno_mercato:
+    error['data-giorno'] = f"Il {values['data'].strftime('%d-%m-%y')} non era {giorno_mercato.lower()}."
+  values['giorno_mercato'] = giorno_mercato
+
+  # mercato
+  values['mercato'] = row.get('mercato', '')
+  if (values['mercato'], giorno_mercato) not in mercati:
+    error['mercato'] = f"Il mercato {values['mercato']} non si tiene di {giorno_mercato.lower()}." \
+      if any(nome == values['mercato'] for nome, _ in mercati) else 'Mercato non valido.'
+
+  # cassa
+  values['cassa'] = row.get('cassa', '')
+  if not re.fullmatch(r'Cassa [1-3]', values['cassa']):
+    error['cassa'] = 'La cassa non è valida.'
+
+  # reparti
+  somma_reparti = 0
+  for i in REPARTI:
+    reparto = f'reparto{i}'
+    try:
+      tot = parse_decimal(row.get(reparto) or '0')
+      if tot.as_tuple().exponent < -2:
+        error[reparto] = f'Il totale del Reparto {i} non può avere più di due cifre decimali.'
+      if tot < 0:
+        error[reparto] = f'Il totale del Reparto {i} non può essere negativo.'
+      values[reparto] = tot
+      somma_reparti += tot
+    except decimal.InvalidOperation:
+      error[reparto] = f'Valore invalido per il totale del Reparto {i}.'
+
+  # quantità
+  somma_quantita = 0
+  for i in REPARTI:
+    quantita = f'quantita{i}'
+    try:
+      tot = int(row.get(quantita) or 0)
+      if tot < 0:
+        error[quantita] = f'La quantità del Reparto {i} non può essere negativa.'
+      values[quantita] = tot
+      somma_quantita += tot
+    except ValueError:
+      error[quantita] = f'Valore invalido per la quantità del Reparto {i}.'
+
+  # totale reparti
+  try:
+    rep_totale = parse_decimal(row.get('totale', ''))
+    if rep_totale.as_tuple().exponent < -2:
+      error['totale'] = 'Il totale non può avere più di due cifre decimali.'
+    elif rep_totale < 0:
+      error['totale'] = 'Il totale non può essere negativo.'
+    elif somma_reparti != rep_totale:
+      error['totale'] = 'La somma dei reparti non coincide col totale.'
+  except decimal.InvalidOperation:
+    error['totale'] = 'Valore invalido per il totale.'
+
+  # n. pezzi
+  try:
+    q_totale = int(row.get('quantita_totale', ''))
+    if q_totale < 0:
+      error['quantita_totale'] = 'Il n. pezzi non può essere negativo.'
+    elif somma_quantita != q_totale:
+      error['quantita_totale'] = 'La somma delle quantità dei reparti non coincide col n. pezzi.'
+  except ValueError:
+    error['quantita_totale'] = 'Valore invalido per il totale.'
+
+  return error, values
+
+# accetta anche la virgola come separatore decimale. 'nan' e 'Infinity'
+# sono Decimal validi ma non importi: li trattiamo come valori invalidi
+def parse_decimal(value):
+  value = decimal.Decimal(value.replace(',', '.'))
+  if not value.is_finite():
+    raise decimal.InvalidOperation(value)
+  return value
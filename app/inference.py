@@ -0,0 +1,414 @@
+import gc
+import importlib.metadata
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+from torch.cuda import OutOfMemoryError
+from app import backends, metrics
+
+# i modelli vengono caricati solo al primo utilizzo (o dal warm-up), così i
+# comandi flask e i riavvii che non leggono scontrini non pagano il caricamento.
+# C'è un backend per dispositivo: 'cuda' se disponibile e uno 'cpu' di riserva,
+# che è quello scelto con OCR_BACKEND
+_backends = {}
+_lock = threading.Lock()
+_state = {
+  'status': 'not loaded',
+  'load_time': None,
+  'warm': False,
+  'error': None
+}
+_settings = {}
+logger = logging.getLogger(__name__)
+
+# semaforo che limita le inferenze contemporanee sulla GPU e richieste in attesa
+_gpu_slots = None
+_gpu_waiting = 0
+
+def init_app(app):
+  app.config.setdefault('OCR_LANGS', ['it'])
+  app.config.setdefault('OCR_WARMUP', False)
+  app.config.setdefault('OCR_DEVICE', 'auto')
+  app.config.setdefault('OCR_GPU_MB_PER_INFERENCE', 1500)
+  app.config.setdefault('OCR_GPU_MAX_CONCURRENCY', 0)
+  app.config.setdefault('OCR_GPU_QUEUE_TIMEOUT', 2.0)
+  app.config.setdefault('OCR_CPU_FALLBACK', True)
+  app.config.setdefault('OCR_MICROBATCH', False)
+  app.config.setdefault('OCR_MICROBATCH_WINDOW', 0.03)
+  app.config.setdefault('OCR_MICROBATCH_MAX', 8)
+  app.config.setdefault('OCR_MICROBATCH_MAX_PADDING', 1.25)
+  app.config.setdefault('OCR_BACKEND', 'cpu')
+  app.config.setdefault('OCR_CPU_THREADS', 0)
+  app.config.setdefault('OCR_ONNX', False)
+  app.config.setdefault('OCR_PRELOAD', False)
+  app.config.setdefault('OCR_INFERENCE_ADDRESS', None)
+  app.config.setdefault('OCR_INFERENCE_AUTHKEY', None)
+  if app.config['OCR_INFERENCE_ADDRESS']:
+    backends.check_remote(app.config['OCR_INFERENCE_ADDRESS'], app.config['OCR_INFERENCE_AUTHKEY'])
+
+  _state['langs'] = list(app.config['OCR_LANGS'])
+  _state['warm_up'] = app.config['OCR_WARMUP']
+  _settings.update({
+    'device': app.config['OCR_DEVICE'],
+    'mb_per_inference': app.config['OCR_GPU_MB_PER_INFERENCE'],
+    'max_concurrency': app.config['OCR_GPU_MAX_CONCURRENCY'],
+    'queue_timeout': app.config['OCR_GPU_QUEUE_TIMEOUT'],
+    'cpu_fallback': app.config['OCR_CPU_FALLBACK'],
+    'max_padding': app.config['OCR_MICROBATCH_MAX_PADDING'],
+    'backend': app.config['OCR_BACKEND'],
+    'backend_options': {
+      'threads': app.config['OCR_CPU_THREADS'],
+      'onnx': app.config['OCR_ONNX'],
+      'onnx_dir': os.path.join(app.instance_path, 'onnx'),
+      'address': app.config['OCR_INFERENCE_ADDRESS'],
+      'authkey': (app.config['OCR_INFERENCE_AUTHKEY'] or '').encode()
+    },
+    'remote': bool(app.config['OCR_INFERENCE_ADDRESS'])
+  })
+
+  if app.config['OCR_MICROBATCH']:
+    start_batcher(app.config['OCR_MICROBATCH_WINDOW'], app.config['OCR_MICROBATCH_MAX'])
+
+  if app.config['OCR_PRELOAD']:
+    preload()
+
+  if app.config['OCR_WARMUP']:
+    threading.Thread(target=warm_up, name='ocr-warmup', daemon=True).start()
+
+# dispositivo principale: 'remote' se c'è un processo di inferenza dedicato,
+# 'cuda' se richiesto o se disponibile, altrimenti 'cpu'
+def primary_device():
+  if _settings.get('remote'):
+    return 'remote'
+  device = _settings.get('device', 'auto')
+  if device == 'auto':
+    import torch
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+  return device
+
+# sulla GPU si usa sempre il backend torch, sulla CPU quello configurato
+def backend_name(device):
+  if device == 'remote':
+    return 'remote'
+  return 'torch' if device == 'cuda' else _settings.get('backend', 'cpu')
+
+def get_backend(device=None):
+  device = device or primary_device()
+  backend = _backends.get(device)
+  if backend is not None:
+    return backend
+
+  with _lock:
+    if device not in _backends:
+      primary = device == primary_device()
+      if primary:
+        _state['status'] = 'loading'
+      start = time.perf_counter()
+      try:
+        cls = backends.BACKENDS[backend_name(device)]
+        _backends[device] = cls(_state.get('langs', ['it']), device, _settings.get('backend_options', {}))
+      except Exception as e:
+        if primary:
+          _state['status'] = 'error'
+          _state['error'] = str(e)
+        raise
+      load_time = time.perf_counter() - start
+      metrics.observe('ocr_model_load_seconds', load_time, device=device, backend=backend_name(device))
+      if primary:
+        _state['load_time'] = load_time
+        _state['status'] = 'ready'
+  return _backends[device]
+
+# forza il dispositivo principale (es. 'cpu' per i benchmark)
+def use_device(device):
+  _settings['device'] = device
+
+# usato dal processo di inferenza dedicato, che deve caricare il modello in locale
+def disable_remote():
+  _settings['remote'] = False
+
+# carica il modello prima del fork dei worker (gunicorn --preload), così i
+# pesi vengono condivisi copy-on-write. gc.freeze() sposta gli oggetti già
+# creati fuori dalla portata del garbage collector, che altrimenti
+# scriverebbe sulle loro pagine facendole copiare in ogni worker.
+# CUDA non sopravvive al fork, quindi con la GPU il precaricamento è saltato
+def preload():
+  device = primary_device()
+  if device == 'cuda':
+    logger.warning('OCR_PRELOAD ignorato: il contesto CUDA non può essere condiviso tra processi')
+    return False
+  get_backend(device)
+  gc.freeze()
+  return True
+
+# nei processi figli i thread del padre non esistono: ricreiamo lock e micro-batcher
+def _after_fork():
+  global _lock, _batcher, _gpu_waiting
+  _lock = threading.Lock()
+  _gpu_waiting = 0
+  if _batcher is not None:
+    _batcher = MicroBatcher(_batcher.window, _batcher.max_batch)
+
+os.register_at_fork(after_in_child=_after_fork)
+
+# memoria del processo in MB: RSS conta anche le pagine condivise, PSS le
+# divide tra i processi che le condividono (solo Linux)
+def memory():
+  res = { 'pid': os.getpid() }
+  try:
+    with open('/proc/self/smaps_rollup') as f:
+      for line in f:
+        name, _, value = line.partition(':')
+        if name in ('Rss', 'Pss', 'Shared_Clean', 'Private_Dirty'):
+          res[name.lower() + '_mb'] = int(value.split()[0]) / 1024
+  except OSError:
+    pass
+  return res
+
+# cambia il backend CPU, scartando quello eventualmente già caricato
+def use_backend(name):
+  with _lock:
+    _settings['backend'] = name
+    _backends.pop('cpu', None)
+
+# carica il modello ed esegue un'inferenza a vuoto, in modo che la prima
+# richiesta vera non paghi l'inizializzazione di CUDA e dei kernel
+def warm_up():
+  try:
+    backend = get_backend()
+    start = time.perf_counter()
+    dummy = np.full((64, 256), 255, dtype=np.uint8)
+    backend.readtext(dummy, detail=0)
+    _state['warm_up_time'] = time.perf_counter() - start
+    _state['warm'] = True
+  except Exception as e:
+    _state['error'] = str(e)
+
+# identifica modello e lingue in uso, senza caricare il modello
+def model_version():
+  try:
+    version = importlib.metadata.version('easyocr')
+  except importlib.metadata.PackageNotFoundError:
+    version = 'unknown'
+  langs = '+'.join(_state.get('langs', ['it']))
+  return f"easyocr-{version}-{langs}-{_settings.get('backend', 'cpu')}"
+
+# se il warm-up è attivo, il modello è pronto solo dopo l'inferenza di prova
+def is_ready():
+  if _state['status'] != 'ready':
+    return False
+  return _state['warm'] or not _state.get('warm_up')
+
+def status():
+  return {
+    **_state,
+    'device': primary_device(),
+    'backend': backend_name(primary_device()),
+    'loaded': { device: backend.name for device, backend in _backends.items() },
+    'gpu_waiting': _gpu_waiting,
+    'memory': memory()
+  }
+
+# numero di inferenze che possono girare insieme sulla GPU, stimato dalla
+# memoria libera una volta caricato il modello
+def gpu_slots():
+  global _gpu_slots
+  if _gpu_slots is None:
+    with _lock:
+      if _gpu_slots is None:
+        import torch
+        free, _ = torch.cuda.mem_get_info()
+        slots = max(1, free // (_settings['mb_per_inference'] * 2**20))
+        if _settings['max_concurrency'] > 0:
+          slots = min(slots, _settings['max_concurrency'])
+        _state['gpu_slots'] = int(slots)
+        metrics.set_gauge('ocr_gpu_slots', int(slots))
+        _gpu_slots = threading.BoundedSemaphore(int(slots))
+  return _gpu_slots
+
+def _waiting(delta):
+  global _gpu_waiting
+  with _lock:
+    _gpu_waiting += delta
+    metrics.set_gauge('ocr_gpu_waiting', _gpu_waiting)
+
+# esegue un metodo del backend (readtext, readtext_batched, ...) rispettando
+# il limite di inferenze sulla GPU. Se la GPU è assente, resta occupata oltre
+# OCR_GPU_QUEUE_TIMEOUT o esaurisce la memoria, l'inferenza passa alla CPU:
+# la richiesta è più lenta ma non fallisce
+def run(method, *args, **kwargs):
+  device = primary_device()
+  # col processo dedicato limiti e fallback vengono applicati dal server
+  if device == 'remote':
+    return call('remote', method, *args, **kwargs)
+  if device != 'cuda':
+    return call('cpu', method, *args, **kwargs)
+
+  # il modello va caricato prima di stimare la memoria libera
+  get_backend('cuda')
+  slots = gpu_slots()
+  cpu_fallback = _settings['cpu_fallback']
+
+  _waiting(1)
+  start = time.perf_counter()
+  acquired = slots.acquire(timeout=_settings['queue_timeout'] if cpu_fallback else None)
+  _waiting(-1)
+  metrics.observe('ocr_gpu_queue_seconds', time.perf_counter() - start)
+
+  if not acquired:
+    metrics.incr('ocr_cpu_fallback_total', reason='saturated')
+    return call('cpu', method, *args, **kwargs)
+
+  try:
+    return call('cuda', method, *args, **kwargs)
+  except OutOfMemoryError:
+    metrics.incr('ocr_gpu_oom_total')
+    import torch
+    torch.cuda.empty_cache()
+    if not cpu_fallback:
+      raise
+  finally:
+    slots.release()
+
+  metrics.incr('ocr_cpu_fallback_total', reason='oom')
+  return call('cpu', method, *args, **kwargs)
+
+def call(device, method, *args, **kwargs):
+  metrics.incr('ocr_inferences_total', device=device)
+  return getattr(get_backend(device), method)(*args, **kwargs)
+
+def readtext(img, **kwargs):
+  if _batcher is not None:
+    return _batcher.submit(img, kwargs).result()
+  return run('readtext', img, **kwargs)
+
+# solo il riconoscitore, sulle regioni già note di img (vedi app.fields)
+def recognize(img, **kwargs):
+  return run('recognize', img, **kwargs)
+
+# raccoglie le letture richieste da thread diversi per una finestra di
+# 'window' secondi (o fino a max_batch immagini) e le esegue in un'unica
+# inferenza batch dal proprio thread, restituendo a ciascuno il suo risultato
+class MicroBatcher:
+  def __init__(self, window, max_batch):
+    self.window = window
+    self.max_batch = max_batch
+    self.pending = queue.Queue()
+    self.thread = threading.Thread(target=self._loop, name='ocr-batcher', daemon=True)
+    self.thread.start()
+
+  def submit(self, img, kwargs):
+    future = Future()
+    self.pending.put((img, kwargs, future))
+    return future
+
+  def stop(self):
+    self.pending.put(None)
+
+  def _loop(self):
+    while True:
+      first = self.pending.get()
+      if first is None:
+        return
+
+      batch = [ first ]
+      deadline = time.monotonic() + self.window
+      while len(batch) < self.max_batch:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+          break
+        try:
+          item = self.pending.get(timeout=timeout)
+        except queue.Empty:
+          break
+        if item is None:
+          self.pending.put(None)
+          break
+        batch.append(item)
+
+      # nello stesso batch solo letture con gli stessi parametri e canali
+      groups = {}
+      for item in batch:
+        img, kwargs, _ = item
+        groups.setdefault((img.ndim, tuple(sorted(kwargs.items()))), []).append(item)
+      for items in groups.values():
+        self._run(items)
+
+  def _run(self, items):
+    imgs = [ img for img, _, _ in items ]
+    kwargs = items[0][1]
+    metrics.observe('ocr_microbatch_size', len(items))
+    try:
+      results = read_by_size(imgs, **kwargs)
+    except Exception as e:
+      for _, _, future in items:
+        future.set_exception(e)
+      return
+    for (_, _, future), result in zip(items, results):
+      future.set_result(result)
+
+_batcher = None
+
+def start_batcher(window, max_batch):
+  global _batcher
+  stop_batcher()
+  _batcher = MicroBatcher(window, max_batch)
+
+def stop_batcher():
+  global _batcher
+  if _batcher is not None:
+    _batcher.stop()
+    _batcher = None
+
+# legge le immagini con una chiamata batch per ogni gruppo di dimensioni
+# simili (vedi size_groups), mantenendo l'ordine dei risultati
+def read_by_size(imgs, **kwargs):
+  results = [ None ] * len(imgs)
+  for group in size_groups(imgs, _settings.get('max_padding', 1.25)):
+    if len(group) == 1:
+      read = [ run('readtext', imgs[group[0]], **kwargs) ]
+    else:
+      read = run('readtext_batched', pad_to_common([ imgs[i] for i in group ]), **kwargs)
+    for i, result in zip(group, read):
+      results[i] = result
+  return results
+
+# divide gli indici di imgs in gruppi in cui nessuna immagine va allungata di
+# più di max_padding volte per lato. EasyOCR riduce l'immagine con il bordo a
+# canvas_size: uno scontrino piccolo nello stesso batch di uno molto più alto
+# perderebbe risoluzione nel rilevatore rispetto alla lettura da solo
+def size_groups(imgs, max_padding):
+  groups = []
+  for i in sorted(range(len(imgs)), key=lambda i: imgs[i].shape[:2]):
+    h, w = imgs[i].shape[:2]
+    if groups:
+      hs, ws = zip(*(imgs[j].shape[:2] for j in groups[-1]))
+      if max(hs + (h,)) <= max_padding * min(hs + (h,)) and max(ws + (w,)) <= max_padding * min(ws + (w,)):
+        groups[-1].append(i)
+        continue
+    groups.append([ i ])
+  return groups
+
+# porta tutte le immagini alla stessa dimensione aggiungendo un bordo nero
+# in basso e a destra, senza deformarle: il rilevatore batch di EasyOCR
+# richiede immagini di dimensioni uguali
+def pad_to_common(imgs):
+  h = max(img.shape[0] for img in imgs)
+  w = max(img.shape[1] for img in imgs)
+  padded = []
+  for img in imgs:
+    pad = [(0, h - img.shape[0]), (0, w - img.shape[1])] + [(0, 0)] * (img.ndim - 2)
+    padded.append(np.pad(img, pad))
+  return padded
+
+# legge più immagini con un'unica chiamata al modello. Con il micro-batching
+# attivo le immagini vengono accodate e possono unirsi a quelle di altre richieste
+def readtext_batched(imgs, **kwargs):
+  if _batcher is not None:
+    futures = [ _batcher.submit(img, kwargs) for img in imgs ]
+    return [ future.result() for future in futures ]
+  return read_by_size(imgs, **kwargs)
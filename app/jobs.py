@@ -0,0 +1,119 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from app import metrics
+
+class QueueFull(Exception):
+  pass
+
+class Job:
+  def __init__(self, owner):
+    self.id = uuid.uuid4().hex
+    self.owner = owner
+    self.status = 'queued'
+    self.submitted = time.monotonic()
+    self.started = None
+    self.finished = None
+    self.payload = None
+    self.code = None
+
+  def wait_time(self):
+    if self.started is None:
+      return time.monotonic() - self.submitted
+    return self.started - self.submitted
+
+# coda di lavori eseguiti da un pool limitato di thread. I lavori terminati
+# restano consultabili per 'ttl' secondi, poi vengono scartati
+class JobQueue:
+  def __init__(self, app, workers, max_pending, ttl):
+    self.app = app
+    self.workers = workers
+    self.max_pending = max_pending
+    self.ttl = ttl
+    self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ocr-job')
+    self.jobs = OrderedDict()
+    self.lock = threading.Lock()
+
+  def submit(self, fn, owner, *args):
+    with self.lock:
+      self._expire()
+      if self._pending() >= self.max_pending:
+        metrics.incr('ocr_jobs_rejected_total')
+        raise QueueFull()
+      job = Job(owner)
+      self.jobs[job.id] = job
+      self._update_gauges()
+
+    metrics.incr('ocr_jobs_submitted_total')
+    self.executor.submit(self._run, job, fn, *args)
+    return job
+
+  def get(self, job_id):
+    with self.lock:
+      return self.jobs.get(job_id)
+
+  # posizione del lavoro nella coda (0 se è già in esecuzione o terminato)
+  def position(self, job):
+    with self.lock:
+      if job.status != 'queued':
+        return 0
+      pos = 0
+      for other in self.jobs.values():
+        if other.status == 'queued':
+          pos += 1
+        if other is job:
+          return pos
+      return 0
+
+  def stats(self):
+    with self.lock:
+      queued = [ job for job in self.jobs.values() if job.status == 'queued' ]
+      running = sum(1 for job in self.jobs.values() if job.status == 'running')
+      oldest = max((job.wait_time() for job in queued), default=0)
+
+    wait = metrics.snapshot()['observations'].get('ocr_job_wait_seconds')
+    return {
+      'workers': self.workers,
+      'max_pending': self.max_pending,
+      'queued': len(queued),
+      'running': running,
+      'oldest_wait': oldest,
+      'wait': wait
+    }
+
+  def _run(self, job, fn, *args):
+    with self.lock:
+      job.status = 'running'
+      job.started = time.monotonic()
+      self._update_gauges()
+    metrics.observe('ocr_job_wait_seconds', job.wait_time())
+
+    try:
+      with self.app.app_context():
+        payload, code = fn(*args)
+    except Exception as e:
+      payload, code = { 'message': f"Errore durante l'elaborazione dell'immagine. Dettagli: <em>{e}</em>" }, 500
+
+    with self.lock:
+      job.payload = payload
+      job.code = code
+      job.status = 'done'
+      job.finished = time.monotonic()
+      self._update_gauges()
+    metrics.observe('ocr_job_run_seconds', job.finished - job.started)
+
+  def _pending(self):
+    return sum(1 for job in self.jobs.values() if job.status != 'done')
+
+  def _expire(self):
+    now = time.monotonic()
+    expired = [ job_id for job_id, job in self.jobs.items()
+                if job.status == 'done' and now - job.finished > self.ttl ]
+    for job_id in expired:
+      del self.jobs[job_id]
+
+  def _update_gauges(self):
+    metrics.set_gauge('ocr_jobs_queued', sum(1 for job in self.jobs.values() if job.status == 'queued'))
+    metrics.set_gauge('ocr_jobs_running', sum(1 for job in self.jobs.values() if job.status == 'running'))
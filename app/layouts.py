@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import threading
+import cv2
+import numpy as np
+from app import inference, metrics
+from app.fields import PROFILES, profile, stack, assign, bounds
+from app.parser import parse_date, parse_int, parse_float
+
+# modelli di layout degli scontrini, uno per cassa. Ogni cassa stampa
+# l'azzeramento reparti sempre allo stesso modo, quindi dalle letture
+# complete si impara dove si trovano i valori dei campi sullo scontrino
+# raddrizzato (box normalizzati su larghezza e altezza) e una firma del
+# layout: il profilo dell'inchiostro riga per riga. Se la foto di una
+# richiesta successiva ha una firma abbastanza simile si ritagliano
+# direttamente le regioni dei campi e si esegue solo il riconoscitore,
+# senza il rilevatore di testo sull'intero scontrino
+
+logger = logging.getLogger(__name__)
+
+# campioni della firma del layout
+SIGNATURE_BINS = 64
+# larghezza a cui viene ridotto lo scontrino per calcolare la firma
+SIGNATURE_WIDTH = 250
+# margini attorno ai box appresi, in frazioni dell'altezza del box e della larghezza dello scontrino
+MARGIN_Y = 0.5
+MARGIN_X = 0.02
+
+class LayoutStore:
+  def __init__(self, path, min_samples, min_score):
+    self.path = path
+    self.min_samples = min_samples
+    self.min_score = min_score
+    self.layouts = {}
+    self.lock = threading.Lock()
+    self._load()
+
+  # modello della cassa compatibile con img. Ritorna il modello, o None,
+  # e se img va capovolta per corrispondere al modello
+  def match(self, cassa, img):
+    with self.lock:
+      layout = self.layouts.get(cassa)
+      if layout is None or layout['samples'] < self.min_samples:
+        return None, False
+      # copia: learn può aggiornare il modello mentre lo stiamo leggendo
+      layout = { **layout, 'fields': dict(layout['fields']) }
+
+    sig, aspect = signature(img)
+    stored = np.array(layout['signature'])
+    # il profilo dell'immagine capovolta è quello letto al contrario
+    straight = score(sig, aspect, stored, layout['aspect'])
+    flipped = score(sig[::-1], aspect, stored, layout['aspect'])
+    metrics.observe('ocr_layout_score', max(straight, flipped))
+    if max(straight, flipped) < self.min_score:
+      return None, False
+    return layout, flipped > straight
+
+  # legge i campi del modello ritagliandone le regioni da img
+  def read(self, img, layout):
+    h, w = img.shape[:2]
+    if img.ndim == 3:
+      img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    groups = {}
+    for field, (x0, x1, y0, y1) in layout['fields'].items():
+      margin_y = (y1 - y0) * MARGIN_Y
+      rect = (max(0, int((x0 - MARGIN_X) * w)), min(w, int((x1 + MARGIN_X) * w)),
+              max(0, int((y0 - margin_y) * h)), min(h, int((y1 + margin_y) * h)))
+      if rect[1] - rect[0] > 4 and rect[3] - rect[2] > 4:
+        groups.setdefault(profile(field), []).append((field, rect))
+
+    parsed = {}
+    confidence = {}
+    for key, group in groups.items():
+      crops = [ img[y0:y1, x0:x1] for _, (x0, x1, y0, y1) in group ]
+      canvas, boxes = stack(crops, 1)
+      with metrics.stage('recognize'):
+        read = inference.recognize(canvas, horizontal_list=boxes, free_list=[], detail=1, **PROFILES[key])
+
+      for (field, _), (text, conf) in zip(group, assign(read, boxes)):
+        if text is None:
+          continue
+        value = parse_value(field, text)
+        if value:
+          parsed[field] = value
+          confidence[field] = float(conf)
+    return parsed, confidence
+
+  # aggiorna il modello della cassa con una lettura completa di img:
+  # 'result' è l'output di readtext(img, detail=1) e 'sources' gli indici dei
+  # token dei campi (vedi parse_ocr_result). Se il layout non corrisponde a
+  # quello salvato (es. la cassa è stata riprogrammata) il modello riparte da capo
+  def learn(self, cassa, img, result, sources):
+    h, w = img.shape[:2]
+    fields = {}
+    for field, i in sources.items():
+      x0, x1, y0, y1 = bounds(result[i][0])
+      fields[field] = [ x0 / w, x1 / w, y0 / h, y1 / h ]
+    sig, aspect = signature(img)
+
+    with self.lock:
+      layout = self.layouts.get(cassa)
+      if layout is None or score(sig, aspect, np.array(layout['signature']), layout['aspect']) < self.min_score:
+        metrics.incr('ocr_layout_learned_total', result='new')
+        layout = self.layouts[cassa] = { 'samples': 0, 'aspect': aspect, 'signature': sig.tolist(), 'fields': {} }
+      else:
+        metrics.incr('ocr_layout_learned_total', result='update')
+
+      # media progressiva di firma e box sui campioni raccolti
+      n = layout['samples']
+      layout['signature'] = ((np.array(layout['signature']) * n + sig) / (n + 1)).tolist()
+      layout['aspect'] = (layout['aspect'] * n + aspect) / (n + 1)
+      for field, box in fields.items():
+        old = layout['fields'].get(field)
+        layout['fields'][field] = box if old is None else [ (o * n + b) / (n + 1) for o, b in zip(old, box) ]
+      layout['samples'] = n + 1
+      self._save()
+
+  def status(self):
+    with self.lock:
+      return { cassa: { 'samples': layout['samples'], 'fields': sorted(layout['fields']) }
+               for cassa, layout in self.layouts.items() }
+
+  def _load(self):
+    try:
+      with open(self.path) as f:
+        self.layouts = json.load(f)
+    except (OSError, ValueError):
+      self.layouts = {}
+
+  def _save(self):
+    tmp = self.path + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        json.dump(self.layouts, f)
+      os.replace(tmp, self.path)
+    except OSError:
+      logger.exception('impossibile salvare i modelli di layout')
+
+# firma del layout: quantità di inchiostro di ogni riga, ricampionata su
+# SIGNATURE_BINS valori a media nulla e norma unitaria, e il rapporto altezza/larghezza
+def signature(img):
+  h, w = img.shape[:2]
+  gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+  small = cv2.resize(gray, (SIGNATURE_WIDTH, max(SIGNATURE_BINS, int(h * SIGNATURE_WIDTH / w))),
+                     interpolation=cv2.INTER_AREA)
+  ink = cv2.adaptiveThreshold(small, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+  rows = ink.mean(axis=1, dtype=np.float64).reshape(-1, 1)
+  sig = cv2.resize(rows, (1, SIGNATURE_BINS), interpolation=cv2.INTER_AREA).ravel()
+  sig -= sig.mean()
+  norm = np.linalg.norm(sig)
+  if norm > 0:
+    sig /= norm
+  return sig, h / w
+
+# correlazione tra le firme, penalizzata dalla differenza di proporzioni.
+# La firma salvata è una media, quindi non ha più norma unitaria
+def score(sig, aspect, stored, stored_aspect):
+  norm = np.linalg.norm(stored)
+  if norm == 0:
+    return 0
+  return float(np.dot(sig, stored)) / norm * min(aspect, stored_aspect) / max(aspect, stored_aspect)
+
+def parse_value(field, text):
+  if field == 'data':
+    return parse_date(' '.join(text.split()))
+  text = ''.join(c for c in text if c.isdigit() or c in ',.')
+  value = parse_int(text) if profile(field) == 'quantita' else parse_float(text)
+  return value if value > 0 else None
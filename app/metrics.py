@@ -0,0 +1,157 @@
+import contextvars
+import cProfile
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# contatori e osservazioni di processo, condivisi tra i thread delle richieste
+# e quelli dei worker in background. Le etichette vengono incorporate nel
+# nome in stile Prometheus, es. ocr_stage_seconds{stage="decode"}
+_lock = threading.Lock()
+counters = defaultdict(float)
+gauges = {}
+observations = {}
+
+# tracce delle richieste in corso che raccolgono le fasi (possono essere annidate)
+_traces = contextvars.ContextVar('traces', default=())
+
+# fasi eseguite e attributi (es. il ramo di fallback preso) di una richiesta
+class Trace:
+  def __init__(self):
+    self.stages = []
+    self.attrs = {}
+
+  def as_dict(self):
+    return {
+      **self.attrs,
+      'stages': [ { 'stage': name, 'ms': round(elapsed * 1000, 1) } for name, elapsed in self.stages ]
+    }
+
+def key(name, labels):
+  if not labels:
+    return name
+  return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+def incr(name, value=1, **labels):
+  with _lock:
+    counters[key(name, labels)] += value
+
+def set_gauge(name, value, **labels):
+  with _lock:
+    gauges[key(name, labels)] = value
+
+# registra un valore (tipicamente una durata in secondi) tenendo solo
+# conteggio, somma e massimo, così la memoria resta costante
+def observe(name, value, **labels):
+  name = key(name, labels)
+  with _lock:
+    obs = observations.get(name)
+    if obs is None:
+      observations[name] = { 'count': 1, 'sum': value, 'max': value }
+    else:
+      obs['count'] += 1
+      obs['sum'] += value
+      obs['max'] = max(obs['max'], value)
+
+# misura la durata di una fase della pipeline OCR
+@contextmanager
+def stage(name):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    observe('ocr_stage_seconds', elapsed, stage=name)
+    for trace in _traces.get():
+      trace.stages.append((name, elapsed))
+
+# aggiunge attributi alle tracce attive
+def annotate(**attrs):
+  for trace in _traces.get():
+    trace.attrs.update(attrs)
+
+# raccoglie in una Trace le fasi eseguite nel blocco, nell'ordine in cui terminano
+@contextmanager
+def collect():
+  trace = Trace()
+  token = _traces.set(_traces.get() + (trace,))
+  try:
+    yield trace
+  finally:
+    _traces.reset(token)
+
+# profila il blocco con probabilità 'rate', salvando il risultato in
+# 'directory': con cProfile un file .prof (da aprire con pstats o snakeviz),
+# con il profiler di torch una traccia .json per chrome://tracing
+@contextmanager
+def profile(rate, mode, directory):
+  if rate <= 0 or random.random() >= rate:
+    yield
+    return
+
+  os.makedirs(directory, exist_ok=True)
+  name = os.path.join(directory, time.strftime('ocr-%Y%m%d-%H%M%S-') + f'{random.randrange(16**4):04x}')
+  incr('ocr_profiled_requests_total', mode=mode)
+
+  if mode == 'torch':
+    import torch
+    activities = [ torch.profiler.ProfilerActivity.CPU ]
+    if torch.cuda.is_available():
+      activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities) as prof:
+      yield
+    prof.export_chrome_trace(name + '.json')
+  else:
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+      yield
+    finally:
+      prof.disable()
+      prof.dump_stats(name + '.prof')
+
+def snapshot():
+  with _lock:
+    res = {
+      'counters': dict(counters),
+      'gauges': dict(gauges),
+      'observations': {}
+    }
+    for name, obs in observations.items():
+      res['observations'][name] = {
+        **obs,
+        'avg': obs['sum'] / obs['count']
+      }
+    return res
+
+# esporta tutte le metriche nel formato testuale di Prometheus. Le
+# osservazioni diventano dei summary (_count, _sum) più un gauge _max
+def prometheus():
+  data = snapshot()
+  families = {}
+
+  def add(name, kind, value, suffix=''):
+    base, _, labels = name.partition('{')
+    family = families.setdefault(base + suffix, (kind, []))
+    family[1].append(f"{base}{suffix}{'{' + labels if labels else ''} {value}")
+
+  for name, value in data['counters'].items():
+    add(name, 'counter', value)
+  for name, value in data['gauges'].items():
+    add(name, 'gauge', value)
+  for name, obs in data['observations'].items():
+    base, _, labels = name.partition('{')
+    labels = '{' + labels if labels else ''
+    family = families.setdefault(base, ('summary', []))
+    family[1].append(f"{base}_count{labels} {obs['count']}")
+    family[1].append(f"{base}_sum{labels} {obs['sum']}")
+    add(name, 'gauge', obs['max'], '_max')
+
+  lines = []
+  for base, (kind, samples) in sorted(families.items()):
+    lines.append(f'# TYPE {base} {kind}')
+    lines.extend(sorted(samples))
+  return '\n'.join(lines) + '\n'
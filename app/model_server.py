@@ -0,0 +1,70 @@
+import logging
+import os
+import threading
+from multiprocessing.connection import Listener
+import click
+from flask import current_app
+from app import inference
+from app.backends import parse_address
+from app.ocr import bp
+
+# processo di inferenza dedicato: carica il modello una volta sola e serve
+# i worker WSGI che hanno OCR_INFERENCE_ADDRESS impostato. Le chiamate di
+# tutti i worker passano dallo scheduler GPU e, se attivo, dal micro-batching
+#
+#   flask ocr serve-model
+
+logger = logging.getLogger(__name__)
+
+METHODS = ('readtext', 'readtext_batched', 'detect', 'recognize')
+
+@bp.cli.command('serve-model')
+def serve_model():
+  config = current_app.config
+  if not config['OCR_INFERENCE_ADDRESS']:
+    raise click.ClickException('Imposta OCR_INFERENCE_ADDRESS nella configurazione.')
+
+  address = parse_address(config['OCR_INFERENCE_ADDRESS'])
+  # un socket Unix rimasto da un'esecuzione precedente impedirebbe il bind
+  if isinstance(address, str) and os.path.exists(address):
+    os.unlink(address)
+
+  inference.disable_remote()
+  inference.get_backend()
+  click.echo(f"Modello caricato ({inference.status()['backend']}), in ascolto su {config['OCR_INFERENCE_ADDRESS']}")
+
+  with Listener(address, authkey=config['OCR_INFERENCE_AUTHKEY'].encode()) as listener:
+    # il socket è accessibile solo all'utente che esegue i worker
+    if isinstance(address, str):
+      os.chmod(address, 0o600)
+    while True:
+      try:
+        conn = listener.accept()
+      except Exception:
+        # es. authkey sbagliata: scartiamo solo quel client
+        logger.exception('connessione rifiutata')
+        continue
+      threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+def handle(conn):
+  with conn:
+    while True:
+      try:
+        method, args, kwargs = conn.recv()
+      except EOFError:
+        return
+
+      if method not in METHODS:
+        conn.send(('error', f'Metodo non consentito: {method}'))
+        continue
+
+      try:
+        # readtext passa dal micro-batching, se attivo, così si uniscono le richieste dei vari worker
+        if method == 'readtext':
+          result = inference.readtext(*args, **kwargs)
+        else:
+          result = inference.run(method, *args, **kwargs)
+        conn.send(('ok', result))
+      except Exception as e:
+        logger.exception("errore durante l'inferenza")
+        conn.send(('error', f'{type(e).__name__}: {e}'))
@@ -1,14 +1,128 @@
-import easyocr
-import re
-from datetime import datetime
+import functools
+import json
+import logging
+import os
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import cv2
 import numpy as np
-from flask import Blueprint, request
+from flask import Blueprint, request, current_app, g, url_for, Response, stream_with_context
 from torch.cuda import OutOfMemoryError
-from app.auth import login_required
+from app.auth import login_required, admin_required
+from app import jobs, inference, metrics, cache, fields, layouts, tiles, corr
+from app.parser import FIELDS, REQUIRED, parse_ocr_result, is_complete, missing_fields, mismatched_totals
+from app.orientation import detect_orientation
 
-reader = easyocr.Reader(['it'])
 bp = Blueprint('ocr', __name__, url_prefix='/ocr')
+logger = logging.getLogger(__name__)
+
+# da incrementare a ogni modifica di app.parser: invalida la cache dei risultati
+PARSER_VERSION = 4
+
+# foto scartate dal controllo di qualità, con il messaggio per l'operatore
+QUALITY_MESSAGES = {
+  'sharpness': 'La foto è sfocata. Tieni fermo il telefono e aspetta che lo scontrino sia a fuoco.',
+  'dark': 'La foto è troppo scura. Scatta in un punto più illuminato.',
+  'bright': 'La foto è sovraesposta. Evita riflessi e luce diretta sullo scontrino.',
+  'contrast': 'La foto ha poco contrasto. Appoggia lo scontrino su uno sfondo scuro.',
+  'area': 'Lo scontrino è troppo piccolo nella foto. Avvicinati in modo che occupi gran parte dell\'inquadratura.',
+  'skew': 'Lo scontrino è troppo inclinato. Allinealo ai bordi della foto.',
+  'corners': 'Non vedo i quattro angoli dello scontrino. Inquadralo tutto su uno sfondo scuro.'
+}
+
+class BatchTooLarge(Exception):
+  pass
+
+class PoorQuality(Exception):
+  def __init__(self, reason):
+    super().__init__(QUALITY_MESSAGES[reason])
+    self.reason = reason
+
+# sovrapposizione minima tra gli angoli inviati dal client e il contorno trovato
+CLIENT_CORNERS_MIN_OVERLAP = 0.8
+
+# sotto questo numero di campi letti la lettura di un ritaglio è considerata
+# insufficiente e si prova anche il ritaglio di fallback
+MIN_FIELDS = 6
+
+IMAGE_MIMETYPES = ('image/jpeg', 'image/webp')
+
+# valori ammessi da corr.validate_input
+CASSE = ('Cassa 1', 'Cassa 2', 'Cassa 3')
+
+# decodifica in scala di grigi, eventualmente già ridotta di 2, 4 o 8 volte
+DECODE_FLAGS = {
+  1: cv2.IMREAD_GRAYSCALE,
+  2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+  4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+  8: cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+
+def init_app(app):
+  inference.init_app(app)
+
+  app.config.setdefault('OCR_ASYNC', False)
+  app.config.setdefault('OCR_WORKERS', 2)
+  app.config.setdefault('OCR_MAX_PENDING', 20)
+  app.config.setdefault('OCR_JOB_TTL', 300)
+  app.config.setdefault('OCR_BATCH_CANDIDATES', False)
+  app.config.setdefault('OCR_ORIENTATION_DETECTION', False)
+  app.config.setdefault('OCR_ORIENTATION_MIN_CONFIDENCE', 0.1)
+  app.config.setdefault('OCR_FUSED_PREPROCESSING', True)
+  app.config.setdefault('OCR_EARLY_EXIT', True)
+  app.config.setdefault('OCR_FIELD_REPAIR', False)
+  app.config.setdefault('OCR_FIELD_REPAIR_MIN_CONFIDENCE', 0.5)
+  app.config.setdefault('OCR_FIELD_REPAIR_SCALE', 2)
+  app.config.setdefault('OCR_FIELD_PROFILES', True)
+  app.config.setdefault('OCR_FIELD_CONFIDENCE', True)
+  app.config.setdefault('OCR_LAYOUTS', False)
+  app.config.setdefault('OCR_LAYOUT_MIN_SCORE', 0.9)
+  app.config.setdefault('OCR_LAYOUT_MIN_SAMPLES', 3)
+  app.config.setdefault('OCR_TILING', False)
+  app.config.setdefault('OCR_TILE_HEIGHT', 1280)
+  app.config.setdefault('OCR_TILE_OVERLAP', 128)
+  app.config.setdefault('OCR_QUALITY_GATE', False)
+  app.config.setdefault('OCR_QUALITY_MIN_SHARPNESS', 15)
+  app.config.setdefault('OCR_QUALITY_MIN_BRIGHTNESS', 40)
+  app.config.setdefault('OCR_QUALITY_MAX_BRIGHTNESS', 235)
+  app.config.setdefault('OCR_QUALITY_MIN_CONTRAST', 10)
+  app.config.setdefault('OCR_QUALITY_MIN_AREA', 0.1)
+  app.config.setdefault('OCR_QUALITY_MAX_SKEW', 30)
+  app.config.setdefault('OCR_BATCH_WORKERS', 4)
+  app.config.setdefault('OCR_BATCH_MAX_IMAGES', 50)
+  app.config.setdefault('OCR_BATCH_MAX_IMAGE_BYTES', 20 * 1024 * 1024)
+  app.config.setdefault('OCR_BATCH_MAX_TOTAL_BYTES', 200 * 1024 * 1024)
+  app.config.setdefault('OCR_DECODE_REDUCTION', 1)
+  app.config.setdefault('OCR_PROFILE_SAMPLE_RATE', 0)
+  app.config.setdefault('OCR_PROFILE_MODE', 'cprofile')
+
+  app.config.setdefault('OCR_CACHE_SIZE', 256)
+  app.config.setdefault('OCR_CACHE_TTL', 24 * 60 * 60)
+  app.config.setdefault('OCR_CACHE_PERSIST', False)
+
+  if app.config['OCR_CACHE_SIZE'] > 0:
+    path = None
+    if app.config['OCR_CACHE_PERSIST']:
+      path = os.path.join(app.instance_path, 'ocr-cache.json')
+    app.extensions['ocr_cache'] = cache.ResultCache(
+      max_size=app.config['OCR_CACHE_SIZE'],
+      ttl=app.config['OCR_CACHE_TTL'],
+      version=f'{PARSER_VERSION}:{inference.model_version()}',
+      path=path)
+
+  if app.config['OCR_LAYOUTS']:
+    app.extensions['ocr_layouts'] = layouts.LayoutStore(
+      os.path.join(app.instance_path, 'ocr-layouts.json'),
+      min_samples=app.config['OCR_LAYOUT_MIN_SAMPLES'],
+      min_score=app.config['OCR_LAYOUT_MIN_SCORE'])
+
+  if app.config['OCR_ASYNC']:
+    app.extensions['ocr_jobs'] = jobs.JobQueue(
+      app,
+      workers=app.config['OCR_WORKERS'],
+      max_pending=app.config['OCR_MAX_PENDING'],
+      ttl=app.config['OCR_JOB_TTL'])
 
 @bp.post('/')
 @login_required
@@ -20,232 +134,597 @@ def ocr():
   
   f = request.files['image']
 
-  if f.filename != 'tmp-photo.jpeg' or f.mimetype != 'image/jpeg':
+  if f.mimetype not in IMAGE_MIMETYPES:
     return {
       'message': 'Formato immagine non supportato'
     }, 400
 
+  data = f.read()
+
+  # la cassa scelta nel form seleziona il modello di layout dello scontrino
+  cassa = request.form.get('cassa')
+  if cassa not in CASSE:
+    cassa = None
+
+  # il client può aver già trovato gli angoli dello scontrino (es. con
+  # /ocr/frame), che vengono usati se coincidono con il contorno (vedi
+  # trusted_roi), o inviare lo scontrino già raddrizzato, che viene solo corretto
+  warped = request.form.get('raddrizzata') == '1'
+  corners = None
+  if not warped and request.form.get('angoli'):
+    corners = parse_corners(request.form['angoli'])
+    if corners is None:
+      return {
+        'message': 'Angoli dello scontrino non validi.'
+      }, 400
+  # la stessa foto reinviata (es. dopo un errore di rete) non viene riletta
+  key, parsed = cached(data, cassa, corners, warped)
+  if parsed is not None:
+    return parsed
+
+  queue = current_app.extensions.get('ocr_jobs')
+  if queue is None:
+    return read_receipt(data, key, cassa, corners, warped)
+
+  # modalità asincrona: rispondiamo subito con l'id del lavoro, il client
+  # interroga job_status finché il risultato non è pronto
+  try:
+    job = queue.submit(read_receipt, g.user.username, data, key, cassa, corners, warped)
+  except jobs.QueueFull:
+    return {
+      'message': 'Il lettore è sovraccarico. Riprova tra qualche minuto.'
+    }, 503
+
+  return {
+    'job': job.id,
+    'status_url': url_for('ocr.job_status', job_id=job.id),
+    'position': queue.position(job)
+  }, 202
+
+# chiave della foto nella cache dei risultati e risultato salvato, se c'è.
+# Cassa, angoli e foto già raddrizzata cambiano il risultato della pipeline
+# e fanno parte della chiave; senza nessuno dei tre la chiave è quella dei
+# soli byte. /ocr/ e /ocr/batch con la stessa cassa condividono i risultati
+def cached(data, cassa=None, corners=None, warped=False):
+  results = current_app.extensions.get('ocr_cache')
+  if results is None:
+    return None, None
+  options = { 'cassa': cassa, 'angoli': corners, 'raddrizzata': warped or None }
+  options = { k: v for k, v in options.items() if v is not None }
+  key = results.key(data + (json.dumps(options, sort_keys=True).encode() if options else b''))
+  return key, results.get(key)
+
+# angoli inviati dal client: JSON con quattro coppie [x, y] in frazioni di
+# larghezza e altezza della foto, nell'ordine tl, tr, br, bl come li
+# ritorna /ocr/frame. Ritorna la lista o None se non sono validi
+def parse_corners(value):
+  try:
+    corners = json.loads(value)
+    if len(corners) == 4 and all(len(p) == 2 and all(0 <= float(c) <= 1 for c in p) for p in corners):
+      return [ [ float(x), float(y) ] for x, y in corners ]
+  except (TypeError, ValueError):
+    pass
+  return None
+
+# lettura di tutti gli scontrini di fine giornata in una sola richiesta: le
+# foto arrivano come più file 'images' o in un archivio zip 'archive'.
+# Vengono lette in parallelo da OCR_BATCH_WORKERS thread, così con il
+# micro-batching attivo le inferenze si uniscono in batch sulla GPU, e ogni
+# risultato viene inviato appena pronto, una riga JSON per foto (NDJSON):
+#
+#   { "indice": 0, "file": "...", "codice": 200, "risultato": {...}, "bozza": {...} }
+#
+# 'bozza' è il corrispettivo precompilato (vedi corr.bozza)
+@bp.post('/batch')
+@login_required
+def batch():
+  config = current_app.config
+  try:
+    images = batch_images()
+  except zipfile.BadZipFile:
+    return {
+      'message': 'L\'archivio non è un file zip valido.'
+    }, 400
+  except BatchTooLarge as e:
+    return {
+      'message': str(e)
+    }, 413
+
+  if not images:
+    return {
+      'message': 'Nessuna immagine inviata'
+    }, 400
+
+  cassa = request.form.get('cassa')
+  if cassa not in CASSE:
+    cassa = None
+  mercati = [ { 'mercato': m.nome, 'giorno': m.giorno } for m in corr.mercati_attivi() ]
+  app = current_app._get_current_object()
+  metrics.incr('ocr_batch_requests_total')
+  metrics.observe('ocr_batch_images', len(images))
+
+  def read_one(data):
+    with app.app_context():
+      key, parsed = cached(data, cassa)
+      if parsed is not None:
+        return parsed, 200
+      return read_receipt(data, key, cassa)
+
+  def generate():
+    executor = ThreadPoolExecutor(max_workers=config['OCR_BATCH_WORKERS'], thread_name_prefix='ocr-batch')
+    try:
+      futures = { executor.submit(read_one, data): (i, name) for i, (name, data) in enumerate(images) }
+      for future in as_completed(futures):
+        i, name = futures[future]
+        payload, code = future.result()
+        line = { 'indice': i, 'file': name, 'codice': code, 'risultato': payload }
+        if code == 200:
+          line['bozza'] = corr.bozza(payload, mercati, cassa)
+        yield json.dumps(line) + '\n'
+    finally:
+      # il client si è disconnesso o abbiamo finito: le foto non ancora iniziate non servono più
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                  headers={ 'X-Accel-Buffering': 'no' })
+
+# coppie (nome, byte) delle foto inviate a batch. Numero e dimensione delle
+# foto vengono controllati prima di leggerle, dalle dimensioni dei file
+# caricati e da quelle dichiarate nell'archivio (zipfile non estrae più
+# byte di quelli dichiarati): se si superano OCR_BATCH_MAX_IMAGES o
+# OCR_BATCH_MAX_TOTAL_BYTES solleva BatchTooLarge senza leggere niente
+def batch_images():
+  config = current_app.config
+  max_bytes = config['OCR_BATCH_MAX_IMAGE_BYTES']
+
+  # (nome, dimensione, funzione che legge i byte)
+  pending = []
+  for f in request.files.getlist('images'):
+    f.stream.seek(0, os.SEEK_END)
+    size = f.stream.tell()
+    f.stream.seek(0)
+    if size <= max_bytes:
+      pending.append((f.filename, size, f.read))
+
+  z = None
+  archive = request.files.get('archive')
+  if archive:
+    z = zipfile.ZipFile(archive)
+    for info in z.infolist():
+      # saltiamo cartelle, file nascosti (es. __MACOSX) e file troppo grandi una volta estratti
+      name = os.path.basename(info.filename)
+      if info.is_dir() or not name or name.startswith('.') or info.file_size > max_bytes:
+        continue
+      if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg', '.png', '.webp'):
+        pending.append((name, info.file_size, functools.partial(z.read, info)))
+
   try:
-    img = cv2.imdecode(np.frombuffer(f.read(), np.uint8), cv2.IMREAD_COLOR)
-    img = cv2.GaussianBlur(img, (3, 3), 0)
-    img = gain_and_bias_correction(img, 3)
-    img, fallback = crop_roi(img)
+    if len(pending) > config['OCR_BATCH_MAX_IMAGES']:
+      raise BatchTooLarge(f"Troppe immagini: al massimo {config['OCR_BATCH_MAX_IMAGES']} per volta.")
+    if sum(size for _, size, _ in pending) > config['OCR_BATCH_MAX_TOTAL_BYTES']:
+      raise BatchTooLarge(f"Immagini troppo grandi: al massimo {config['OCR_BATCH_MAX_TOTAL_BYTES'] // (1024 * 1024)} MB per volta.")
+    return [ (name, read()) for name, _, read in pending ]
+  finally:
+    if z is not None:
+      z.close()
+
+# inquadratura dal vivo: la pagina della fotocamera invia qui frequentemente
+# fotogrammi piccoli (lato lungo di qualche centinaio di pixel) e riceve in
+# pochi millisecondi gli angoli dello scontrino, in frazioni di larghezza e
+# altezza del fotogramma, e se la foto può essere scattata. Si eseguono
+# solo la ricerca del contorno di crop_roi e le misure di qualità, senza OCR
+@bp.post('/frame')
+@login_required
+def frame():
+  f = request.files.get('image')
+  if f is None:
+    return {
+      'message': 'Nessuna immagine inviata'
+    }, 400
+
+  start = time.perf_counter()
+  img = cv2.imdecode(np.frombuffer(f.read(), np.uint8), cv2.IMREAD_GRAYSCALE)
+  if img is None:
+    return {
+      'message': 'Formato immagine non supportato'
+    }, 400
+
+  # stessa copia e stesse misure del controllo di qualità di /ocr/, così la
+  # guida all'inquadratura e il server danno la stessa risposta
+  small, ratio = small_gray(img)
+  roi, _, cnt = find_roi(cv2.LUT(small, gain_lut(small, 3)), ratio)
+  quality = measure_quality(small, cnt)
+
+  reason = quality_problem(quality)
+  if reason is None and roi is None:
+    reason = 'corners'
+
+  corners = None
+  if roi is not None:
+    h, w = img.shape[:2]
+    corners = [ [ round(float(x) / w, 4), round(float(y) / h, 4) ] for x, y in roi ]
+
+  metrics.incr('ocr_frame_requests_total', ok=reason is None)
+  metrics.observe('ocr_frame_seconds', time.perf_counter() - start)
+  return {
+    'ok': reason is None,
+    'angoli': corners,
+    'motivo': reason,
+    'message': QUALITY_MESSAGES.get(reason),
+    'qualita': { k: round(v, 3) for k, v in quality.items() }
+  }
+
+@bp.get('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+  queue = current_app.extensions.get('ocr_jobs')
+  job = queue.get(job_id) if queue else None
+  if job is None or job.owner != g.user.username:
+    return {
+      'message': 'Lettura non trovata o scaduta. Riprova a scansionare lo scontrino.'
+    }, 404
+
+  if job.status != 'done':
+    return {
+      'job': job.id,
+      'status': job.status,
+      'position': queue.position(job),
+      'wait': job.wait_time()
+    }, 202
+
+  return job.payload, job.code
+
+@bp.get('/jobs')
+@login_required
+@admin_required
+def jobs_stats():
+  queue = current_app.extensions.get('ocr_jobs')
+  if queue is None:
+    return { 'async': False }
+  return { 'async': True, **queue.stats() }
+
+# modelli di layout appresi per ogni cassa
+@bp.get('/layouts')
+@login_required
+@admin_required
+def layouts_status():
+  store = current_app.extensions.get('ocr_layouts')
+  if store is None:
+    return { 'enabled': False }
+  return { 'enabled': True, 'layouts': store.status() }
+
+# contatori della pipeline (es. quante volte serve ancora la rilettura capovolta)
+@bp.get('/stats')
+@login_required
+@admin_required
+def stats():
+  return metrics.snapshot()
+
+# metriche per Prometheus
+@bp.get('/metrics')
+@login_required
+@admin_required
+def prometheus_metrics():
+  return metrics.prometheus(), 200, { 'Content-Type': 'text/plain; version=0.0.4' }
+
+# readiness per il load balancer: 200 solo quando il modello è caricato
+@bp.get('/health')
+def health():
+  status = inference.status()
+  return status, 200 if inference.is_ready() else 503
+
+# esegue tutta la pipeline sull'immagine codificata. Ritorna la coppia
+# (payload, codice HTTP), così può essere usata sia dalla route sia dai worker
+def read_receipt(data, key=None, cassa=None, corners=None, warped=False):
+  config = current_app.config
+  profile_dir = os.path.join(current_app.instance_path, 'profiles')
+  with metrics.collect() as trace, \
+       metrics.profile(config['OCR_PROFILE_SAMPLE_RATE'], config['OCR_PROFILE_MODE'], profile_dir):
+    start = time.perf_counter()
+    payload, code = run_pipeline(data, key, cassa, corners, warped)
+    elapsed = time.perf_counter() - start
+
+  metrics.incr('ocr_requests_total', code=code)
+  metrics.observe('ocr_request_seconds', elapsed)
+  logger.info('ocr %s', json.dumps({
+    'code': code,
+    'ms': round(elapsed * 1000, 1),
+    'fields': len(FIELDS & payload.keys()) if code == 200 else 0,
+    **trace.as_dict()
+  }))
+  return payload, code
+
+def run_pipeline(data, key, cassa=None, corners=None, warped=False):
+  try:
+    fused = current_app.config['OCR_FUSED_PREPROCESSING']
+    with metrics.stage('decode'):
+      flags = DECODE_FLAGS[current_app.config['OCR_DECODE_REDUCTION']] if fused else cv2.IMREAD_COLOR
+      img = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    # file corrotto o formato che questa build di OpenCV non sa decodificare (es. WebP)
+    if img is None:
+      metrics.incr('ocr_decode_errors_total')
+      return {
+        'message': 'Formato immagine non supportato'
+      }, 400
+
+    if fused:
+      img, fallback = preprocess(img, corners, warped)
+    else:
+      # qualità misurata sulla foto originale, come nella pipeline fusa
+      quality = check_image(small_gray(img)[0])
+      with metrics.stage('blur'):
+        img = cv2.GaussianBlur(img, (3, 3), 0)
+      with metrics.stage('gain'):
+        img = gain_and_bias_correction(img, 3)
+      with metrics.stage('crop'):
+        if warped:
+          fallback = None
+        elif corners is not None:
+          small, ratio = small_gray(img)
+          roi, (x, y, rw, rh), cnt = trusted_roi(corners, small, ratio, img.shape)
+          check_roi(quality, small, cnt)
+          img, fallback = (warp(img, roi) if roi is not None else None), img[y:y+rh, x:x+rw]
+        else:
+          img, fallback = crop_roi(img, quality)
+    metrics.annotate(hint='raddrizzata' if warped else 'angoli' if corners else None)
 
     parsed = None
-    if img is not None:
+    confidence = {}
+    if current_app.config['OCR_BATCH_CANDIDATES']:
+      branch = 'batched'
+      parsed = read_candidates(img, fallback)
+    elif current_app.config['OCR_EARLY_EXIT']:
+      if cassa and img is not None and 'ocr_layouts' in current_app.extensions:
+        branch = 'layout'
+        parsed, confidence = read_layout(img, cassa)
+      if not parsed:
+        parsed, confidence, branch = read_until_complete(img, fallback, cassa)
+    elif img is not None:
+      branch = 'warped'
       parsed = read_img(img)
-      if len(parsed) < 6:
+      if len(parsed) < 6 and fallback is not None:
+        branch = 'warped+fallback'
         parsed2 = read_img(fallback)
         parsed |= parsed2
     else:
+      branch = 'fallback'
       parsed = read_img(fallback)
 
+    metrics.incr('ocr_branch_total', branch=branch)
+    metrics.annotate(branch=branch)
+
     if len(parsed) == 0:
+      metrics.incr('ocr_empty_parse_total')
       return {
         'message': 'Impossibile leggere lo scontrino. Prova a scattare una foto migliore, con luminosità uniforme e su sfondo scuro.'
       }, 500
+
+    # corr.js evidenzia i totali che non coincidono con la somma dei reparti
+    mismatched = mismatched_totals(parsed)
+    if mismatched:
+      parsed['somme_incoerenti'] = mismatched
+
+    # corr.js evidenzia i campi letti con poca sicurezza
+    if current_app.config['OCR_FIELD_CONFIDENCE'] and confidence:
+      parsed['confidenza'] = { field: round(c, 3) for field, c in confidence.items() if field in parsed }
     
-    return parsed
+    results = current_app.extensions.get('ocr_cache')
+    if key is not None and results is not None:
+      results.put(key, parsed)
+
+    return parsed, 200
   
+  except PoorQuality as e:
+    metrics.incr('ocr_quality_rejected_total', reason=e.reason)
+    metrics.annotate(branch='rejected')
+    return {
+      'message': str(e)
+    }, 422
+
   except OutOfMemoryError:
+    # succede solo se OCR_CPU_FALLBACK è disattivato
     return {
       'message': 'La GPU ha esaurito la memoria. Riprova tra qualche minuto.'
     }, 500
   
   except Exception as e:
+    logger.exception("errore durante l'elaborazione dell'immagine")
+    metrics.incr('ocr_errors_total', error=type(e).__name__)
     return {
       'message': f"Errore durante l'elaborazione dell'immagine. Dettagli: <em>{e}</em>"
     }, 500
 
-def parse_ocr_result(lst):
-  j = 1
-  res = {}
-  current_rep = None
-  l = len(lst)
-  while j <= l:
-    i = j-1
-    word = lst[i].lower()
-    # sistemiamo gli spazi, in modo che ce ne sia solo uno tra una parola e l'altra
-    word = ' '.join(word.split())
-    nxt = None
-    if j != l:
-      nxt = lst[j]
-    
-    if is_like(word, 'reparto totale'):
-      if nxt:
-        n = parse_float(nxt)
-        res['totale'] = n
-        j += 1
-        continue
+# ruota in verticale le immagini orizzontali
+def upright(img):
+  h, w = img.shape[:2]
+  if w > h:
+    # l'immagine è orizzontale
+    img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+  return img
 
-    elif is_like(word, 'reparto'):
-      # potrebbe essere 'reparto totale'
-      if nxt and is_like(' '.join(nxt.lower().split()), 'totale'):
-        if j+1 < l:
-          nxt = lst[j+1]
-          n = parse_float(nxt)
-          res['totale'] = n
-          j += 2
-          continue
-      else:
-        n = get_rep(word, nxt)
-        if n > 0:
-          current_rep = n
-          j += 1
-          continue
-        elif current_rep:
-          # non è stato riconosciuto il numero del reparto. Se è stato letto almeno un reparto,
-          # proviamo a indovinare che il reparto corrente è il successivo all'ultimo letto
-          current_rep += 1
-          j += 1
-          continue 
-
-    elif is_like(word, 'quantita'):
-      if nxt:
-        n = parse_int(nxt)
-        if current_rep and n > 0:
-          res[f'quantita{current_rep}'] = n
-          j += 1
-          continue
-
-    elif is_like(word, 'totale'):
-      if nxt:
-        n = parse_float(nxt)
-        if current_rep and n > 0:
-          res[f'reparto{current_rep}'] = n
-          j += 1
-          continue
-
-    elif is_like(word, 'pezzi'):
-      if nxt:
-        n = parse_int(nxt)
-        if n > 0:
-          res['quantita_totale'] = n
-          j += 1
-          continue
-
-    is_date = False
-    # cerca un pattern "<due cifre>-<due cifre>-<almeno quattro cifre>"
-    # che potrebbe indicare una data
-    match = re.match(r"\b\d{2}-\d{2}-\d{4,}\b", word)
-    if match:
-      # se ho matchato anche l'orario, prendo solo la parte con la data
-      match = match.group(0)[:10]
-      try:
-        date = datetime.strptime(match, '%d-%m-%Y')
-        res['data'] = date.strftime('%Y-%m-%d')
-        is_date = True
-      except ValueError:
-        pass
-
-    if not is_date:    
-        # proviamo il pattern "<due cifre> <due cifre> <almeno quattro cifre>"
-        match = re.match(r"\b\d{2}\s\d{2}\s\d{4,}\b", word)
-        if match:
-          match = match.group(0)[:10]
-          try:
-            date = datetime.strptime(match, '%d %m %Y')
-            res['data'] = date.strftime('%Y-%m-%d')
-            is_date = True
-          except ValueError:
-            pass
-
-    if not is_date:
-        # proviamo il pattern "<due cifre>-<due cifre> <almeno quattro cifre>"
-        match = re.match(r"\b\d{2}-\d{2}\s\d{4,}\b", word)
-        if match:
-          match = match.group(0)[:10]
-          try:
-            date = datetime.strptime(match, '%d-%m %Y')
-            res['data'] = date.strftime('%Y-%m-%d')
-            is_date = True
-          except ValueError:
-            pass
-              
-    if not is_date:
-        # infine il pattern "<due cifre> <due cifre>-<almeno quattro cifre>"
-        match = re.match(r"\b\d{2}-\d{2}-\d{4,}\b", word)
-        if match:
-          match = match.group(0)[:10]
-          try:
-            date = datetime.strptime(match, '%d %m-%Y')
-            res['data'] = date.strftime('%Y-%m-%d')
-          except ValueError:
-            pass
-
-    j += 1
-  return res
+# orienta l'immagine secondo detect_orientation. Ritorna l'immagine e se
+# la stima è abbastanza affidabile da evitare la rilettura capovolta
+def orient(img):
+  if not current_app.config['OCR_ORIENTATION_DETECTION']:
+    return img, False
 
-def is_like(word, target):
-  match = 0
-  l = min(len(word), len(target))
-  for i in range(l):
-    if word[i] == target[i]:
-      match += 1
-  return match / len(target) >= 0.6
-
-# ottiene il numero del reparto che si sta leggendo
-# controllando sia la parola stessa ('reparto n') sia la successiva
-# (in caso di situazioni tipo 'reparto' 'n'). Se fallisce, ritorna 0
-def get_rep(word, nxt):
-  rep = 0
-  try:
-    rep = int(word[-1])
-  except ValueError:
-    if nxt:
-      try:
-        rep = int(nxt)
-      except ValueError:
-        pass
-  
-  if rep > 5:
-    rep = 0
-  
-  return rep
+  with metrics.stage('orientation'):
+    angle, confidence = detect_orientation(img)
+  confident = confidence >= current_app.config['OCR_ORIENTATION_MIN_CONFIDENCE']
+  if not confident:
+    metrics.incr('ocr_orientation_uncertain_total')
+  elif angle == 180:
+    metrics.incr('ocr_orientation_flipped_total')
+    img = cv2.rotate(img, cv2.ROTATE_180)
+  else:
+    metrics.incr('ocr_orientation_upright_total')
+  return img, confident
 
-def parse_int(word):
-  word = word.replace(' ', '')
-  # i leading 0 sono quasi sicuramente 8
-  if len(word) > 1 and word[0] == '0':
-    word = '8' + word[1:]
-  try:
-    n = int(word)
-    return n
-  except ValueError:
-    return 0
-
-def parse_float(word):
-  word = word.replace(' ', '').replace(',', '.')
-  # il leading 0 non seguito da virgola è quasi sicuramente un 8
-  if len(word) > 1 and word[0] == '0' and word[1] != '.':
-    word = '8' + word[1:]
-  try:
-    n = float(word)
-    return n
-  except ValueError:
-    return 0
+# una lettura completa dell'immagine così com'è. Con detail=1 ritorna
+# anche box e confidenze di ogni testo letto e l'indice del testo da cui è
+# stato letto ogni campo, che servono a fields e layouts. Con OCR_TILING
+# gli scontrini lunghi vengono letti a strisce (tiles.read_tiled)
+def read_pass(img, detail=0):
+  config = current_app.config
+  tile = config['OCR_TILE_HEIGHT']
+  overlap = config['OCR_TILE_OVERLAP']
+  tall = img.shape[0] > tile + overlap
+  metrics.annotate(tall=tall)
+
+  if config['OCR_TILING'] and tall:
+    result = tiles.read_tiled(img, tile, overlap)
+    if not detail:
+      result = [ text for _, text, _ in result ]
+  else:
+    with metrics.stage('readtext'):
+      result = inference.readtext(img, detail=detail)
+  texts = [ text for _, text, _ in result ] if detail else result
+  sources = {}
+  with metrics.stage('parse'):
+    parsed = parse_ocr_result(texts, sources)
+  logger.debug('testo letto: %s', texts)
+  return parsed, result, sources
+
+# lettura con il modello di layout della cassa, solo con il riconoscitore.
+# Ritorna campi vuoti se non c'è un modello abbastanza simile o se la
+# lettura non è completa: in quel caso si rilegge con il rilevamento del testo
+def read_layout(img, cassa):
+  store = current_app.extensions['ocr_layouts']
+  img = upright(img)
+  with metrics.stage('layout'):
+    layout, flipped = store.match(cassa, img)
+  if layout is None:
+    metrics.incr('ocr_layout_total', result='miss')
+    return {}, {}
+
+  if flipped:
+    img = cv2.rotate(img, cv2.ROTATE_180)
+  parsed, confidence = store.read(img, layout)
+  if not is_complete(parsed):
+    metrics.incr('ocr_layout_total', result='incomplete')
+    logger.debug('lettura con il modello di layout incompleta: %s', parsed)
+    return {}, {}
+
+  metrics.incr('ocr_layout_total', result='hit')
+  return parsed, confidence
 
 def read_img(img):
-  h, w = img.shape[:2]
-  if w > h:
-    # l'immagine è orizzontale
-    img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+  img, confident = orient(upright(img))
       
-  result = reader.readtext(img, detail=0)
-  parsed = parse_ocr_result(result)
+  parsed = read_pass(img)[0]
   read = len(parsed)
-  if read < 6:
+  # se l'orientamento è stato stimato con sicurezza rileggiamo capovolto solo
+  # quando non si è letto quasi nulla, cioè quando la stima era sbagliata
+  if read < 6 and (not confident or read < 2):
     # risultato non soddisfacente, capovolgiamo l'immagine
-    img = cv2.rotate(img, cv2.ROTATE_180)
-    result = reader.readtext(img, detail=0)
-    parsed2 = parse_ocr_result(result)
+    metrics.incr('ocr_orientation_fallback_total')
+    parsed2 = read_pass(cv2.rotate(img, cv2.ROTATE_180))[0]
     if len(parsed2) > read:
+      metrics.incr('ocr_orientation_fallback_better_total')
       parsed = parsed2
   
-  print(result)
-  print(parsed)
+  logger.debug('campi letti: %s', parsed)
   return parsed
 
+# legge i ritagli uno alla volta fermandosi appena la lettura è completa
+# (parser.is_complete) o un'altra lettura non può più migliorarla (vedi
+# can_fill): i ritagli successivi aggiungono solo i campi mancanti, quindi
+# se le somme non tornano il risultato viene segnalato in run_pipeline. Rispetto a read_img + fallback la soglia fissa sul
+# numero di campi è sostituita da: la versione capovolta di un ritaglio si
+# legge solo se l'orientamento è dubbio o la lettura non ha trovato quasi
+# nulla; il ritaglio di fallback solo se mancano ancora dei campi, che
+# completano quelli già letti senza sovrascriverli. Con OCR_FIELD_REPAIR,
+# prima di passare al ritaglio successivo si rileggono solo le regioni dei
+# valori mancanti o incerti (fields.repair).
+# Le letture complete del solo ritaglio prospettico aggiornano il modello
+# di layout della cassa. Ritorna i campi letti, la loro confidenza e il
+# ramo preso, per le metriche
+def read_until_complete(img, fallback, cassa=None):
+  config = current_app.config
+  store = current_app.extensions.get('ocr_layouts') if cassa else None
+  detail = int(config['OCR_FIELD_REPAIR'] or config['OCR_FIELD_CONFIDENCE'] or store is not None)
+  parsed = {}
+  confidence = {}
+  passes = []
+  reads = 0
+  for name, crop in (('warped', img), ('fallback', fallback)):
+    if crop is None:
+      continue
+
+    crop, confident = orient(upright(crop))
+    found, result, sources = read_pass(crop, detail)
+    passes.append(name)
+    reads += 1
+
+    if not is_complete({ **found, **parsed }) and (len(found) < 2 or (not confident and len(found) < 6)):
+      metrics.incr('ocr_orientation_fallback_total')
+      flipped = cv2.rotate(crop, cv2.ROTATE_180)
+      found2, result2, sources2 = read_pass(flipped, detail)
+      passes.append(name + '-flipped')
+      reads += 1
+      if len(found2) > len(found):
+        metrics.incr('ocr_orientation_fallback_better_total')
+        crop, found, result, sources = flipped, found2, result2, sources2
+
+    if store is not None and name == 'warped' and is_complete(found):
+      store.learn(cassa, crop, result, sources)
+
+    parsed = { **found, **parsed }
+    if detail:
+      confidence = { **fields.confidences(result, sources), **confidence }
+    if config['OCR_FIELD_REPAIR'] and not is_complete(parsed):
+      repaired, repaired_confidence = fields.repair(crop, result, parsed, confidence)
+      if repaired:
+        passes.append(name + '-repair')
+        parsed |= repaired
+        confidence |= repaired_confidence
+
+    if is_complete(parsed):
+      metrics.incr('ocr_complete_reads_total')
+      break
+    if not can_fill(parsed):
+      metrics.incr('ocr_mismatched_reads_total')
+      break
+
+  metrics.observe('ocr_passes_per_receipt', reads)
+  logger.debug('campi letti: %s, mancanti: %s', parsed, sorted(missing_fields(parsed)))
+  return parsed, confidence, '+'.join(passes)
+
+# un altro ritaglio può aggiungere qualcosa solo se manca uno dei campi
+# presenti su ogni scontrino o se si sono letti meno di MIN_FIELDS campi,
+# come in read_img. I reparti mancanti di una lettura altrimenti buona sono
+# di solito reparti senza vendite, che nessuna lettura può trovare
+def can_fill(parsed):
+  return bool(REQUIRED & missing_fields(parsed)) or len(parsed) < MIN_FIELDS
+
+# come read_img, ma legge in un'unica inferenza batch tutti i candidati
+# (ritaglio prospettico e di fallback, dritti e capovolti) e sceglie poi
+# il risultato migliore con la stessa euristica sul numero di campi letti
+def read_candidates(img, fallback):
+  crops = [ orient(upright(crop)) for crop in (img, fallback) if crop is not None ]
+  candidates = []
+  owners = []
+  for i, (crop, confident) in enumerate(crops):
+    candidates.append(crop)
+    owners.append(i)
+    # con orientamento sicuro non serve leggere anche la versione capovolta
+    if not confident:
+      candidates.append(cv2.rotate(crop, cv2.ROTATE_180))
+      owners.append(i)
+
+  with metrics.stage('readtext'):
+    results = inference.readtext_batched(candidates, detail=0)
+  with metrics.stage('parse'):
+    parsed = [ parse_ocr_result(result) for result in results ]
+
+  # per ogni ritaglio teniamo l'orientamento con più campi, a parità quello dritto
+  best = [ max((p for p, owner in zip(parsed, owners) if owner == i), key=len)
+           for i in range(len(crops)) ]
+  res = best[0]
+  if len(best) > 1 and len(res) < 6:
+    res |= best[1]
+  return res
+
 def distance(x, y):
   return np.sqrt(((x[0] - y[0]) ** 2) + ((x[1] - y[1]) ** 2))
 
@@ -266,44 +745,68 @@ def scale_img(img, new_max):
   shrinked = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
   return shrinked, new_width, new_height, ratio
 
-def crop_roi(img):
-  shrinked, w, _, ratio = scale_img(img, 500)
-  gray = cv2.cvtColor(shrinked, cv2.COLOR_BGR2GRAY)
-  gray = cv2.GaussianBlur(gray, (5, 5), 0)
+# copia in scala di grigi con il lato lungo di 500 px su cui si cercano il
+# contorno e si misura la qualità, e il rapporto con la scala originale.
+# Le soglie OCR_QUALITY_* valgono per questa scala
+def small_gray(img):
+  small, _, _, ratio = scale_img(img, 500)
+  if small.ndim == 3:
+    small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+  return small, ratio
+
+# 'quality' sono le misure di check_image, prese sulla foto prima della
+# correzione del contrasto, come nella pipeline fusa
+def crop_roi(img, quality):
+  gray, ratio = small_gray(img)
+  roi, rect, cnt = find_roi(gray, ratio)
+  check_roi(quality, gray, cnt)
+  # senza contorno il fallback è l'intera foto
+  x, y, rw, rh = rect or (0, 0, img.shape[1], img.shape[0])
+
+  # rettangolo di delimitazione di fallback
+  fallback = img[y:y+rh, x:x+rw]
+  if roi is None:
+    return None, fallback
+  return warp(img, roi), fallback
+
+# cerca lo scontrino nell'immagine rimpicciolita in scala di grigi 'small'.
+# Ritorna i quattro vertici (tl, tr, br, bl) riportati alla scala originale
+# con 'ratio', o None se il contorno non è un quadrilatero, il rettangolo
+# di delimitazione del contorno, anche lui in scala originale, e il
+# contorno stesso nella scala di 'small'. Senza contorni ritorna tre None
+def find_roi(small, ratio):
+  w = small.shape[1]
+  gray = cv2.GaussianBlur(small, (5, 5), 0)
   _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
       
   contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)    
+  # immagine uniforme (es. fotocamera coperta): nessun contorno
+  if not contours:
+    return None, None, None
   cnt = max(contours, key=cv2.contourArea)
 
-  # rettangolo di delimitazione di fallback
-  x, y, rw, rh = (int(val * ratio) for val in cv2.boundingRect(cnt))
-  fallback = img[y:y+rh, x:x+rw]
+  rect = tuple(int(val * ratio) for val in cv2.boundingRect(cnt))
   
   peri = cv2.arcLength(cnt, True)
   epsilon = 0.01 * peri
   approx = cv2.approxPolyDP(cnt, epsilon, True)
       
   # ordino sulle y
-  pts = sorted(approx, key=lambda p: p[0][1])
-  pts = np.array(pts).reshape(len(pts), 2)
+  pts = approx.reshape(-1, 2)
+  pts = pts[np.argsort(pts[:, 1], kind='stable')]
 
   if len(pts) < 4:
-    return None, fallback
+    return None, rect, cnt
 
   if len(pts) > 4:
-    selected = np.zeros((4, 2), dtype='int32')
-    selected[0] = pts[0]
-    i = 1
-    while distance(selected[0], pts[i]) < w/3:
-      i += 1
-    selected[1] = pts[i]
-
-    selected[3] = pts[-1]
-    i = -2
-    while distance(selected[3], pts[i]) < w/3:
-      i -= 1
-    selected[2] = pts[i]
-    pts = selected
+    # il secondo vertice in alto è il primo punto, dall'alto, lontano
+    # almeno w/3 dal più alto; il secondo in basso è l'ultimo lontano
+    # almeno w/3 dal più basso
+    top = np.flatnonzero(np.hypot(*(pts - pts[0]).T) >= w/3)
+    bottom = np.flatnonzero(np.hypot(*(pts[:-1] - pts[-1]).T) >= w/3)
+    if len(top) == 0 or len(bottom) == 0:
+      return None, rect, cnt
+    pts = pts[[ 0, top[0], bottom[-1], -1 ]]
 
   # ordiniamo i punti da top-left a bottom-right in senso orario
   # li ho già ordinati per y, basta guardare la x
@@ -317,8 +820,42 @@ def crop_roi(img):
   else:
     roi[2], roi[3] = pts[2], pts[3]
 
-  # proiettiamo i punti e applichiamo la distorsione
+  # proiettiamo i punti sull'immagine originale
   roi *= ratio
+  return roi, rect, cnt
+
+# angoli del client (frazioni) in pixel di un'immagine di dimensioni
+# 'shape', come li ritorna find_roi, con il loro rettangolo di delimitazione
+def client_roi(corners, shape):
+  h, w = shape[:2]
+  roi = np.array(corners, dtype='float32') * np.array([ w, h ], dtype='float32')
+  return roi, cv2.boundingRect(roi)
+
+# angoli del client come li ritorna find_roi, se coincidono con il contorno
+# trovato sulla copia ridotta 'small'. Gli angoli possono venire da un
+# fotogramma precedente o con un'inquadratura diversa da quella della foto:
+# se la sovrapposizione con il contorno è sotto CLIENT_CORNERS_MIN_OVERLAP
+# si usa il contorno trovato. Senza contorno ci si fida del client
+def trusted_roi(corners, small, ratio, shape):
+  roi, rect = client_roi(corners, shape)
+  cnt = (roi / ratio).astype(np.int32).reshape(-1, 1, 2)
+  found = find_roi(small, ratio)
+  if found[2] is not None and overlap(cnt, found[2], small.shape) < CLIENT_CORNERS_MIN_OVERLAP:
+    metrics.incr('ocr_client_corners_rejected_total')
+    if found[0] is None:
+      return None, found[1], found[2]
+    return found
+  return roi, rect, cnt
+
+# intersezione su unione delle aree di due contorni in un'immagine di dimensioni 'shape'
+def overlap(a, b, shape):
+  mask_a = cv2.drawContours(np.zeros(shape[:2], np.uint8), [ a ], -1, 1, cv2.FILLED)
+  mask_b = cv2.drawContours(np.zeros(shape[:2], np.uint8), [ b ], -1, 1, cv2.FILLED)
+  union = np.count_nonzero(mask_a | mask_b)
+  return np.count_nonzero(mask_a & mask_b) / union if union else 0
+
+# raddrizza il quadrilatero roi (tl, tr, br, bl) di img
+def warp(img, roi):
   tl, tr, br, bl = roi
   
   widthA = distance(br, bl)
@@ -339,38 +876,158 @@ def crop_roi(img):
   )
   
   M = cv2.getPerspectiveTransform(roi, dst)
-  warped = cv2.warpPerspective(img, M, (maxWidth, maxHeight))
+  return cv2.warpPerspective(img, M, (maxWidth, maxHeight))
+
+# pipeline di preprocessing a bassa risoluzione: istogramma, contorno e
+# vertici dello scontrino vengono calcolati su un'unica copia rimpicciolita
+# in scala di grigi; l'immagine a piena risoluzione viene solo raddrizzata
+# (o ritagliata), corretta con la LUT e sfocata, una volta sola alla fine.
+# Ritorna, come crop_roi, il ritaglio prospettico (o None) e quello di fallback
+# Con 'corners' (gli angoli trovati dal client, vedi parse_corners) il
+# contorno serve solo a verificarli (trusted_roi); con 'warped' lo scontrino
+# è già raddrizzato e viene solo corretto, senza ritaglio di fallback
+def preprocess(img, corners=None, warped=False):
+  with metrics.stage('gain'):
+    small, ratio = small_gray(img)
+    lut = gain_lut(small, 3)
+
+  # prima di cercare il contorno scartiamo le foto buie, uniformi o sfocate
+  quality = check_image(small)
+
+  if warped:
+    h, w = small.shape
+    check_roi(quality, small, np.array([ [0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1] ], np.int32).reshape(-1, 1, 2))
+    with metrics.stage('blur'):
+      gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+      return finish(gray, lut), None
+
+  with metrics.stage('crop'):
+    if corners is not None:
+      roi, rect, cnt = trusted_roi(corners, cv2.LUT(small, lut), ratio, img.shape)
+    else:
+      roi, rect, cnt = find_roi(cv2.LUT(small, lut), ratio)
+    # senza contorno il fallback è l'intera foto
+    x, y, rw, rh = rect or (0, 0, img.shape[1], img.shape[0])
+
+  # prima del lavoro a piena risoluzione scartiamo le foto illeggibili
+  check_roi(quality, small, cnt)
+
+  with metrics.stage('crop'):
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    warped = warp(gray, roi) if roi is not None else None
+
+  with metrics.stage('blur'):
+    if warped is not None:
+      warped = finish(warped, lut)
+    # il fallback è una vista di gray: va elaborato dopo il warp perché
+    # LUT e blur lavorano sul posto
+    fallback = finish(gray[y:y+rh, x:x+rw], lut)
   return warped, fallback
 
+# misure di qualità della foto sulla copia rimpicciolita in scala di grigi,
+# prima della correzione del contrasto: nitidezza (varianza del
+# laplaciano), luminosità media e contrasto (deviazione standard)
+def measure_image(small):
+  mean, std = cv2.meanStdDev(small)
+  return {
+    'sharpness': float(cv2.Laplacian(small, cv2.CV_64F).var()),
+    'brightness': float(mean[0][0]),
+    'contrast': float(std[0][0])
+  }
+
+# misure sul contorno dello scontrino nella copia rimpicciolita: frazione
+# dell'immagine occupata e inclinazione in gradi del rettangolo minimo che
+# lo contiene. Senza contorno lo scontrino non occupa niente
+def measure_roi(small, cnt):
+  if cnt is None:
+    return { 'area': 0.0, 'skew': 0.0 }
+  angle = cv2.minAreaRect(cnt)[2] % 90
+  return {
+    'area': float(cv2.contourArea(cnt)) / (small.shape[0] * small.shape[1]),
+    'skew': float(min(angle, 90 - angle))
+  }
+
+def measure_quality(small, cnt):
+  return { **measure_image(small), **measure_roi(small, cnt) }
+
+# controlli sull'immagine intera, da fare prima della ricerca del contorno:
+# una foto buia o uniforme non ha uno scontrino da cercare. Ritorna le
+# misure, da completare con check_roi
+def check_image(small):
+  with metrics.stage('quality'):
+    quality = measure_image(small)
+  gate(quality)
+  return quality
+
+def check_roi(quality, small, cnt):
+  with metrics.stage('quality'):
+    quality = { **quality, **measure_roi(small, cnt) }
+  gate(quality)
+  return quality
+
+# con OCR_QUALITY_GATE solleva PoorQuality se la foto non supera le soglie.
+# Le misure finiscono comunque nella traccia, per tarare le soglie con il benchmark
+def gate(quality):
+  metrics.annotate(quality={ k: round(v, 3) for k, v in quality.items() })
+  if current_app.config['OCR_QUALITY_GATE']:
+    reason = quality_problem(quality)
+    if reason:
+      raise PoorQuality(reason)
+
+# primo motivo per cui la foto non supera le soglie OCR_QUALITY_*, o None.
+# Luminosità e contrasto vengono prima della nitidezza: una foto buia o
+# uniforme è anche priva di dettagli, ma il motivo utile è il primo.
+# Area e inclinazione si controllano solo se sono state misurate
+def quality_problem(quality):
+  config = current_app.config
+  if quality['brightness'] < config['OCR_QUALITY_MIN_BRIGHTNESS']:
+    return 'dark'
+  if quality['brightness'] > config['OCR_QUALITY_MAX_BRIGHTNESS']:
+    return 'bright'
+  if quality['contrast'] < config['OCR_QUALITY_MIN_CONTRAST']:
+    return 'contrast'
+  if quality['sharpness'] < config['OCR_QUALITY_MIN_SHARPNESS']:
+    return 'sharpness'
+  if quality.get('area', 1) < config['OCR_QUALITY_MIN_AREA']:
+    return 'area'
+  if quality.get('skew', 0) > config['OCR_QUALITY_MAX_SKEW']:
+    return 'skew'
+  return None
+
+def finish(img, lut):
+  img = cv2.LUT(img, lut, dst=img)
+  return cv2.GaussianBlur(img, (3, 3), 0, dst=img)
+
+# stretching del contrasto: taglia il threshold% dei pixel più scuri e più
+# chiari e distribuisce il resto su tutta la scala di grigi. La correzione
+# viene applicata sul posto con una LUT, senza copie in float dell'immagine
 def gain_and_bias_correction(img, threshold):
-  gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-  hist = cv2.calcHist([gray], [0], None, [256], [0,256])
-  hist_size = len(hist)
+  gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+  return cv2.LUT(img, gain_lut(gray, threshold), dst=img)
+
+# calcola la LUT di gain_and_bias_correction dall'istogramma di gray
+def gain_lut(gray, threshold):
+  hist = cv2.calcHist([gray], [0], None, [256], [0,256]).ravel()
 
-  # calcola l'istogramma delle frequenze cumulate
-  accumulator = []
-  accumulator.append(float(hist[0][0]))
-  for i in range(1, hist_size):
-    accumulator.append(accumulator[i -1] + float(hist[i][0]))
+  # istogramma delle frequenze cumulate
+  accumulator = np.cumsum(hist, dtype=np.float64)
 
   n_px = accumulator[-1]
   clip_thresh = n_px * (threshold / 100) / 2
 
-  minimum_gray = 0
-  while accumulator[minimum_gray] < clip_thresh:
-    minimum_gray += 1
+  # primo livello che supera la soglia inferiore e ultimo sotto quella superiore
+  minimum_gray = int(np.searchsorted(accumulator, clip_thresh, side='left'))
+  maximum_gray = int(np.searchsorted(accumulator, n_px - clip_thresh, side='left')) - 1
 
-  maximum_gray = hist_size -1
-  while accumulator[maximum_gray] >= (n_px - clip_thresh):
-    maximum_gray -= 1
+  # immagine uniforme (es. fotocamera coperta): niente da stirare
+  if maximum_gray <= minimum_gray:
+    return np.arange(256, dtype=np.uint8)
 
   alpha = 255 / (maximum_gray - minimum_gray)
   beta = -minimum_gray * alpha
 
-  img = img * alpha + beta
-  img[img < 0] = 0
-  img[img > 255] = 255
-  return img.astype(np.uint8)
+  lut = np.arange(256) * alpha + beta
+  return np.clip(lut, 0, 255).astype(np.uint8)
 
 # codice per salvare l'immagine sul server
 
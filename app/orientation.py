@@ -0,0 +1,62 @@
+import cv2
+import numpy as np
+
+# stima se lo scontrino (già raddrizzato e in verticale) è dritto o
+# capovolto dall'allineamento delle parole. Le etichette ('REPARTO 1',
+# 'QUANTITA'', 'TOTALE', ...) sono allineate a sinistra su quasi ogni riga,
+# mentre gli importi allineati a destra ci sono solo su alcune: su uno
+# scontrino dritto ci sono più parole che iniziano alla stessa x di parole
+# che finiscono alla stessa x, su uno capovolto il contrario. Il testo degli
+# scontrini è maiuscolo e senza discendenti, quindi la distribuzione
+# dell'inchiostro dentro le righe non dà indicazioni affidabili
+
+# larghezza a cui viene portato lo scontrino per l'analisi
+WIDTH = 600
+# parole più vicine di così al bordo sono tagliate dal ritaglio e non contano
+MARGIN = 0.02
+
+# ritorna l'angolo stimato (0 o 180) e la confidenza della stima, tra 0 e 1
+def detect_orientation(img):
+  x0, x1, height = words(img)
+  if height is None:
+    return 0, 0
+
+  margin = MARGIN * WIDTH
+  left = peak(x0[x0 > margin], height / 2)
+  right = peak(x1[x1 < WIDTH - margin], height / 2)
+  if left + right == 0:
+    return 0, 0
+  score = (left - right) / (left + right)
+  return (0 if score >= 0 else 180), abs(score)
+
+# estremi sinistro e destro delle parole e altezza tipica del testo, alla
+# larghezza WIDTH. Le lettere vengono unite in parole con una chiusura
+# orizzontale; macchie, puntini e bordi vengono scartati dall'altezza
+def words(img):
+  h, w = img.shape[:2]
+  gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+  interpolation = cv2.INTER_AREA if w > WIDTH else cv2.INTER_CUBIC
+  gray = cv2.resize(gray, (WIDTH, max(1, round(h * WIDTH / w))), interpolation=interpolation)
+
+  ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15)
+  ink = cv2.morphologyEx(ink, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (WIDTH // 40, 1)))
+  _, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+  stats = stats[1:]
+  heights = stats[:, cv2.CC_STAT_HEIGHT]
+  widths = stats[:, cv2.CC_STAT_WIDTH]
+
+  candidates = heights[(heights > 5) & (widths > heights)]
+  if len(candidates) == 0:
+    return None, None, None
+  height = float(np.median(candidates))
+
+  keep = (heights >= 0.6 * height) & (heights <= 1.6 * height) & (widths >= height)
+  x0 = stats[keep, cv2.CC_STAT_LEFT]
+  return x0, x0 + widths[keep], height
+
+# massimo numero di valori di v entro ±tol da uno stesso valore
+def peak(v, tol):
+  if len(v) == 0:
+    return 0
+  v = np.sort(v)
+  return int((np.searchsorted(v, v + tol, side='right') - np.searchsorted(v, v - tol)).max())
@@ -0,0 +1,220 @@
+import re
+from datetime import datetime
+from functools import lru_cache
+
+# parser del testo letto dall'OCR sullo scontrino di azzeramento reparti.
+# Scorre i token una volta sola: le parole chiave vengono riconosciute con
+# un confronto fuzzy memorizzato per parola e le date con pattern precompilati
+
+KEYWORDS = ('reparto totale', 'reparto', 'quantita', 'totale', 'pezzi')
+
+# numeri dei reparti dello scontrino di azzeramento
+REPARTI = range(1, 6)
+
+# campi dello scontrino, nell'ordine del form di inserimento. È l'unica
+# definizione: form, importazione, analisi e benchmark la importano da qui
+CAMPI = (
+  'data',
+  *(f'reparto{i}' for i in REPARTI),
+  *(f'quantita{i}' for i in REPARTI),
+  'totale',
+  'quantita_totale'
+)
+FIELDS = frozenset(CAMPI)
+# campi che ci sono su ogni scontrino, anche senza vendite in qualche reparto
+REQUIRED = frozenset([ 'data', 'totale', 'quantita_totale' ])
+
+# "<due cifre><sep><due cifre><sep><almeno quattro cifre>", con i separatori
+# '-' o spazio nelle combinazioni che si trovano sugli scontrini
+DATE_PATTERNS = [
+  (re.compile(r"\b\d{2}-\d{2}-\d{4,}\b"), '%d-%m-%Y'),
+  (re.compile(r"\b\d{2}\s\d{2}\s\d{4,}\b"), '%d %m %Y'),
+  (re.compile(r"\b\d{2}-\d{2}\s\d{4,}\b"), '%d-%m %Y'),
+  (re.compile(r"\b\d{2}\s\d{2}-\d{4,}\b"), '%d %m-%Y')
+]
+
+# se viene passato il dizionario 'sources', vi registra per ogni campo
+# l'indice del token da cui è stato letto il valore
+def parse_ocr_result(lst, sources=None):
+  res = {}
+  if sources is None:
+    sources = {}
+  current_rep = None
+  # sistemiamo gli spazi, in modo che ce ne sia solo uno tra una parola e l'altra
+  words = [ ' '.join(token.lower().split()) for token in lst ]
+  l = len(lst)
+  j = 1
+  while j <= l:
+    # ci fermiamo appena abbiamo letto tutti i campi
+    if len(res) == len(FIELDS):
+      break
+
+    i = j-1
+    word = words[i]
+    nxt = None
+    if j != l:
+      nxt = lst[j]
+
+    keyword = match_keyword(word)
+
+    if keyword == 'reparto totale':
+      if nxt:
+        res['totale'] = parse_float(nxt)
+        sources['totale'] = j
+        j += 1
+        continue
+
+    elif keyword == 'reparto':
+      # potrebbe essere 'reparto totale'
+      if nxt and 'totale' in keywords(words[j]):
+        if j+1 < l:
+          res['totale'] = parse_float(lst[j+1])
+          sources['totale'] = j+1
+          j += 2
+          continue
+      else:
+        n = get_rep(word, nxt)
+        if n > 0:
+          current_rep = n
+          j += 1
+          continue
+        elif current_rep:
+          # non è stato riconosciuto il numero del reparto. Se è stato letto almeno un reparto,
+          # proviamo a indovinare che il reparto corrente è il successivo all'ultimo letto
+          current_rep += 1
+          j += 1
+          continue
+
+    elif keyword == 'quantita':
+      if nxt:
+        n = parse_int(nxt)
+        if current_rep and n > 0:
+          res[f'quantita{current_rep}'] = n
+          sources[f'quantita{current_rep}'] = j
+          j += 1
+          continue
+
+    elif keyword == 'totale':
+      if nxt:
+        n = parse_float(nxt)
+        if current_rep and n > 0:
+          res[f'reparto{current_rep}'] = n
+          sources[f'reparto{current_rep}'] = j
+          j += 1
+          continue
+
+    elif keyword == 'pezzi':
+      if nxt:
+        n = parse_int(nxt)
+        if n > 0:
+          res['quantita_totale'] = n
+          sources['quantita_totale'] = j
+          j += 1
+          continue
+
+    date = parse_date(word)
+    if date:
+      res['data'] = date
+      sources['data'] = i
+
+    j += 1
+  return res
+
+# la lettura è completa quando ci sono data e totali e i reparti letti
+# tornano con i totali, come controlla corr.validate_input. I reparti senza
+# vendite non compaiono tra i campi letti, quindi non servono tutti e cinque
+def is_complete(parsed):
+  if not REQUIRED <= parsed.keys():
+    return False
+  return not mismatched_totals(parsed)
+
+# totali letti ('totale', 'quantita_totale') che non coincidono con la somma
+# dei reparti letti
+def mismatched_totals(parsed):
+  mismatched = []
+  if 'totale' in parsed and abs(sum(parsed.get(f'reparto{i}', 0) for i in REPARTI) - parsed['totale']) >= 0.005:
+    mismatched.append('totale')
+  if 'quantita_totale' in parsed and sum(parsed.get(f'quantita{i}', 0) for i in REPARTI) != parsed['quantita_totale']:
+    mismatched.append('quantita_totale')
+  return mismatched
+
+def missing_fields(parsed):
+  return FIELDS - parsed.keys()
+
+# parole chiave a cui somiglia la parola (già normalizzata). Il vocabolario è
+# fisso e le parole sugli scontrini si ripetono, quindi il risultato viene memorizzato
+@lru_cache(maxsize=4096)
+def keywords(word):
+  return frozenset(target for target in KEYWORDS if is_like(word, target))
+
+# prima parola chiave nell'ordine di KEYWORDS a cui somiglia la parola, o None
+@lru_cache(maxsize=4096)
+def match_keyword(word):
+  found = keywords(word)
+  for target in KEYWORDS:
+    if target in found:
+      return target
+  return None
+
+# la parola somiglia al target se almeno il 60% dei caratteri del target
+# coincide con quello nella stessa posizione della parola
+def is_like(word, target):
+  match = sum(map(str.__eq__, word, target))
+  return match / len(target) >= 0.6
+
+# ritorna la data nel formato '%Y-%m-%d' se la parola inizia con una data, altrimenti None
+def parse_date(word):
+  # tutti i pattern iniziano con due cifre
+  if not word[:2].isdigit():
+    return None
+
+  for pattern, fmt in DATE_PATTERNS:
+    match = pattern.match(word)
+    if match:
+      # se ho matchato anche l'orario, prendo solo la parte con la data
+      try:
+        return datetime.strptime(match.group(0)[:10], fmt).strftime('%Y-%m-%d')
+      except ValueError:
+        pass
+  return None
+
+# ottiene il numero del reparto che si sta leggendo
+# controllando sia la parola stessa ('reparto n') sia la successiva
+# (in caso di situazioni tipo 'reparto' 'n'). Se fallisce, ritorna 0
+def get_rep(word, nxt):
+  rep = 0
+  try:
+    rep = int(word[-1])
+  except ValueError:
+    if nxt:
+      try:
+        rep = int(nxt)
+      except ValueError:
+        pass
+
+  if rep not in REPARTI:
+    rep = 0
+
+  return rep
+
+def parse_int(word):
+  word = word.replace(' ', '')
+  # i leading 0 sono quasi sicuramente 8
+  if len(word) > 1 and word[0] == '0':
+    word = '8' + word[1:]
+  try:
+    n = int(word)
+    return n
+  except ValueError:
+    return 0
+
+def parse_float(word):
+  word = word.replace(' ', '').replace(',', '.')
+  # il leading 0 non seguito da virgola è quasi sicuramente un 8
+  if len(word) > 1 and word[0] == '0' and word[1] != '.':
+    word = '8' + word[1:]
+  try:
+    n = float(word)
+    return n
+  except ValueError:
+    return 0
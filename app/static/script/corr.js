@@ -1,6 +1,9 @@
 'use strict'
 
 const MAX_DIMENSION_PX = 3000
+const JOB_POLL_INTERVAL_MS = 1000
+// sotto questa confidenza il valore letto dall'OCR va controllato
+const OCR_MIN_CONFIDENCE = 0.5
 
 const mercatoInput = document.getElementById('mercato')
 const giornoInput = document.getElementById('giorno_mercato')
@@ -67,7 +70,7 @@ inputs.forEach(el => {
 
     // rimuoviamo l'evidenziazione dell'OCR se l'utente corregge il valore
     if (el.classList.contains('ocr-input')) {
-      el.classList.remove('ocr-input')
+      el.classList.remove('ocr-input', 'ocr-uncertain')
     }
 
     // imponiamo le due cifre decimali
@@ -142,34 +145,33 @@ ocr.addEventListener('change', async e => {
     const { width, height } = img
     const largest = Math.max(width, height)
 
-    // ridimensiona se necessario
-    if (largest > MAX_DIMENSION_PX) {
-      let w, h
-      if (width > height) {
-        w = MAX_DIMENSION_PX
-        h = height * (w / width)
-      } else {
-        h = MAX_DIMENSION_PX
-        w = width * (h / height)
-      }
-
-      const canvas = document.createElement('canvas')
-      canvas.width = w
-      canvas.height = h
-      canvas.getContext('2d').drawImage(img, 0, 0, w, h)
-
-      file = await new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg'))
-    }
+    // ridisegniamo sempre la foto, ridimensionata se necessario: in scala di
+    // grigi e in WebP (se il browser lo supporta) il file da inviare è molto più piccolo
+    const scale = Math.min(1, MAX_DIMENSION_PX / largest)
+    const canvas = document.createElement('canvas')
+    canvas.width = width * scale
+    canvas.height = height * scale
+    const ctx = canvas.getContext('2d')
+    ctx.filter = 'grayscale(1)'
+    ctx.drawImage(img, 0, 0, canvas.width, canvas.height)
+    file = await encodeImage(canvas)
 
     // manda la richiesta
     const fd = new FormData()
-    fd.append('image', file, 'tmp-photo.jpeg')
+    fd.append('image', file, file.type === 'image/webp' ? 'tmp-photo.webp' : 'tmp-photo.jpeg')
+    // la cassa seleziona il modello di layout dello scontrino
+    fd.append('cassa', document.getElementById('cassa').value)
     try {
-      const res = await fetch(ocrEndpoint, {
+      let res = await fetch(ocrEndpoint, {
         method: 'POST',
         body: fd
       })
 
+      // in modalità asincrona il server risponde 202 con l'id del lavoro
+      if (res.status === 202) {
+        res = await waitForJob(await res.json())
+      }
+
       if (!res.ok) {
         loading.close()
         errDialog.showModal()
@@ -187,9 +189,16 @@ ocr.addEventListener('change', async e => {
 
       const payload = await res.json()
       const read = Object.keys(payload)
+      const confidence = payload.confidenza ?? {}
+      // totali che non coincidono con la somma dei reparti letti
+      const mismatched = payload.somme_incoerenti ?? []
       inputs.forEach(el => {
+        el.classList.remove('ocr-uncertain')
         if (read.includes(el.name)) {
           el.classList.add('ocr-input')
+          if (confidence[el.name] < OCR_MIN_CONFIDENCE || mismatched.includes(el.name)) {
+            el.classList.add('ocr-uncertain')
+          }
           if (el.name.includes('reparto') || el.name === 'totale') {
             el.value = parseFloat(payload[el.name]).toFixed(2)
           } else {
@@ -214,6 +223,27 @@ ocr.addEventListener('change', async e => {
   }
 })
 
+// interroga lo stato del lavoro OCR finché il server non ritorna il risultato
+async function waitForJob (job) {
+  const statusUrl = job.status_url
+  while (true) {
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS))
+    const res = await fetch(statusUrl)
+    if (res.status !== 202) {
+      return res
+    }
+  }
+}
+
+// WebP se il browser sa codificarlo (altrimenti toBlob ritorna un PNG), se no JPEG
+async function encodeImage (canvas) {
+  const webp = await new Promise(resolve => canvas.toBlob(resolve, 'image/webp', 0.85))
+  if (webp?.type === 'image/webp') {
+    return webp
+  }
+  return new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', 0.9))
+}
+
 function loadImageFromFile(file) {
   return new Promise((resolve, reject) => {
     const reader = new FileReader()
@@ -1,6 +1,13 @@
 'use strict'
 
+// ogni quanto inviare al server un fotogramma per controllare l'inquadratura e a che dimensione
+const FRAME_INTERVAL_MS = 500
+const FRAME_MAX_PX = 400
+
 const video = document.getElementById('video')
+const overlay = document.getElementById('overlay')
+const framing = document.getElementById('framing')
+const frameCanvas = document.createElement('canvas')
 
 const helpBtn = document.getElementById('help-btn')
 const help = document.getElementById('help')
@@ -27,6 +34,12 @@ let imgReady = false
 let blob
 let previewSrc
 
+let frameTimer
+let frameBusy = false
+// ultimo esito dell'inquadratura e angoli dello scontrino al momento dello scatto
+let lastFrame
+let shotCorners
+
 // TODO: Sistemare la roba della memoria
 
 let resolution = {
@@ -79,8 +92,89 @@ video.addEventListener('loadedmetadata', e => {
 
   preview.width = window.innerWidth
   preview.height = video.videoHeight * window.innerWidth / video.videoWidth
+
+  startFraming()
 })
 
+// guida all'inquadratura: il server ritorna gli angoli dello scontrino e se la foto si può scattare
+function startFraming () {
+  stopFraming()
+  frameTimer = setInterval(checkFrame, FRAME_INTERVAL_MS)
+}
+
+function stopFraming () {
+  clearInterval(frameTimer)
+  frameTimer = null
+  lastFrame = null
+  overlay.getContext('2d').clearRect(0, 0, overlay.width, overlay.height)
+  framing.hidden = true
+  scatta.classList.remove('ready')
+}
+
+async function checkFrame () {
+  // un solo fotogramma alla volta: se il server è lento saltiamo i successivi
+  if (frameBusy || !video.videoWidth) {
+    return
+  }
+
+  frameBusy = true
+  try {
+    const scale = Math.min(1, FRAME_MAX_PX / Math.max(video.videoWidth, video.videoHeight))
+    frameCanvas.width = video.videoWidth * scale
+    frameCanvas.height = video.videoHeight * scale
+    frameCanvas.getContext('2d').drawImage(video, 0, 0, frameCanvas.width, frameCanvas.height)
+    const frame = await new Promise(resolve => frameCanvas.toBlob(resolve, 'image/jpeg', 0.7))
+
+    const fd = new FormData()
+    fd.append('image', frame, 'frame.jpeg')
+    const res = await fetch(frameEndpoint, { method: 'POST', body: fd })
+    // la fotocamera potrebbe essere stata fermata nel frattempo
+    if (res.ok && frameTimer) {
+      lastFrame = await res.json()
+      drawFrame(lastFrame)
+    }
+  } catch (error) {
+    console.log(error)
+  } finally {
+    frameBusy = false
+  }
+}
+
+function drawFrame (frame) {
+  overlay.width = overlay.clientWidth
+  overlay.height = overlay.clientHeight
+  const ctx = overlay.getContext('2d')
+  ctx.clearRect(0, 0, overlay.width, overlay.height)
+
+  scatta.classList.toggle('ready', frame.ok)
+  framing.hidden = frame.ok
+  framing.textContent = frame.message ?? ''
+
+  if (!frame.angoli) {
+    return
+  }
+
+  // il video è scalato per stare tutto nello schermo (object-fit: contain)
+  const scale = Math.min(overlay.width / video.videoWidth, overlay.height / video.videoHeight)
+  const offsetX = (overlay.width - video.videoWidth * scale) / 2
+  const offsetY = (overlay.height - video.videoHeight * scale) / 2
+
+  ctx.beginPath()
+  frame.angoli.forEach(([ x, y ], i) => {
+    const px = offsetX + x * video.videoWidth * scale
+    const py = offsetY + y * video.videoHeight * scale
+    if (i === 0) {
+      ctx.moveTo(px, py)
+    } else {
+      ctx.lineTo(px, py)
+    }
+  })
+  ctx.closePath()
+  ctx.lineWidth = 4
+  ctx.strokeStyle = frame.ok ? 'limegreen' : 'orange'
+  ctx.stroke()
+}
+
 helpBtn.addEventListener('click', () => {
   help.showModal()
 })
@@ -98,8 +192,14 @@ scatta.addEventListener('click', async e => {
   scatta.hidden = true
 
   if (imageCapture) {
+    // la foto di takePhoto può avere proporzioni e inquadratura diverse dal
+    // video: gli angoli dell'inquadratura non valgono, li cerca il server
+    shotCorners = null
     await takePicture()
   } else {
+    // la foto è un fotogramma del video: valgono gli angoli dell'ultima
+    // inquadratura, che il server confronta comunque con il contorno
+    shotCorners = lastFrame?.ok ? lastFrame.angoli : null
     takePictureFallback()
   }
 
@@ -147,6 +247,7 @@ function takePictureFallback () {
 }
 
 function stopCamera () {
+  stopFraming()
   const videoTrack = stream.getVideoTracks()[0]
   videoTrack.stop()
   stream.removeTrack(videoTrack)
@@ -171,6 +272,7 @@ function reinitUI () {
   scatta.hidden = false
   imgReady = false
   blob = null
+  shotCorners = null
   invia.disabled = true
   invia.classList.add('disabled')
   // icona FontAwesome spinner
@@ -182,11 +284,21 @@ invia.addEventListener('click', async () => {
     loading.showModal()
     
     if (!blob) {
-      blob = await new Promise(resolve => hq.toBlob(resolve, 'image/jpeg'))
+      // in scala di grigi e in WebP, se supportato, il file da inviare è molto più piccolo
+      const gray = document.createElement('canvas')
+      gray.width = hq.width
+      gray.height = hq.height
+      const ctx = gray.getContext('2d')
+      ctx.filter = 'grayscale(1)'
+      ctx.drawImage(hq, 0, 0)
+      blob = await encodeImage(gray)
     }
     
     const fd = new FormData()
-    fd.append('image', blob, 'tmp-img.jpeg')
+    fd.append('image', blob, blob.type === 'image/webp' ? 'tmp-img.webp' : 'tmp-img.jpeg')
+    if (shotCorners) {
+      fd.append('angoli', JSON.stringify(shotCorners))
+    }
     
     if (imageCapture) {
       fd.append('imageCapure', true)
@@ -230,6 +342,15 @@ invia.addEventListener('click', async () => {
   }
 })
 
+// WebP se il browser sa codificarlo (altrimenti toBlob ritorna un PNG), se no JPEG
+async function encodeImage (canvas) {
+  const webp = await new Promise(resolve => canvas.toBlob(resolve, 'image/webp', 0.85))
+  if (webp?.type === 'image/webp') {
+    return webp
+  }
+  return new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', 0.9))
+}
+
 errBtn.addEventListener('click', () => {
   errDialog.close()
   reinitUI()
@@ -0,0 +1,49 @@
+import math
+from app import inference, metrics
+
+# lettura a strisce degli scontrini lunghi. Raddrizzato, uno scontrino
+# lungo è molto alto e stretto: il rilevatore lo ridimensiona per farlo
+# stare nel proprio canvas e il testo piccolo perde risoluzione. Lo si
+# taglia quindi in strisce orizzontali sovrapposte, tutte della stessa
+# altezza, lette alla risoluzione originale in un'unica inferenza batch.
+# Ogni striscia tiene solo i box il cui centro cade nella sua metà della
+# sovrapposizione: con una sovrapposizione più alta di una riga di testo
+# ogni riga viene tenuta una sola volta, dalla striscia che la contiene intera
+
+# posizioni (inizio) delle strisce alte 'tile' che coprono un'immagine alta
+# h, distribuite in modo uniforme con sovrapposizione di almeno 'overlap'
+def strips(h, tile, overlap):
+  if h <= tile:
+    return [ 0 ]
+  n = math.ceil((h - overlap) / (tile - overlap))
+  return [ round(i * (h - tile) / (n - 1)) for i in range(n) ]
+
+# intervallo di y di cui è responsabile ogni striscia
+def zones(starts, tile, h):
+  bounds = [ 0 ]
+  for prev, nxt in zip(starts, starts[1:]):
+    bounds.append((nxt + prev + tile) / 2)
+  bounds.append(h)
+  return list(zip(bounds, bounds[1:]))
+
+# legge img a strisce e ritorna il risultato nello stesso formato di
+# readtext(img, detail=1), con i box nelle coordinate di img
+def read_tiled(img, tile, overlap):
+  h = img.shape[0]
+  starts = strips(h, tile, overlap)
+  metrics.observe('ocr_tiles_per_image', len(starts))
+
+  with metrics.stage('readtext'):
+    results = inference.readtext_batched([ img[s:s+tile] for s in starts ], detail=1)
+
+  # le strisce sono in ordine dall'alto e ognuna è già in ordine di lettura
+  merged = []
+  for start, (top, bottom), result in zip(starts, zones(starts, tile, h), results):
+    for box, text, confidence in result:
+      box = [ [ float(x), float(y) + start ] for x, y in box ]
+      center = (box[0][1] + box[2][1]) / 2
+      if top <= center < bottom:
+        merged.append((box, text, confidence))
+      else:
+        metrics.incr('ocr_tile_duplicates_total')
+  return merged
@@ -0,0 +1,82 @@
+# Confronta gain_and_bias_correction con l'implementazione originale
+# (istogramma cumulato in Python e aritmetica float64 sull'immagine intera):
+# verifica che l'output sia identico e misura latenza e picco di memoria.
+#
+# Uso, dalla root del repository:
+#   python benchmarks/gain_and_bias.py [cartella immagini] [ripetizioni]
+#
+# Il picco di memoria è misurato con tracemalloc, che vede le allocazioni
+# di NumPy ma non quelle interne di OpenCV.
+
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from app.ocr import gain_and_bias_correction
+
+def reference(img, threshold):
+  gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+  hist = cv2.calcHist([gray], [0], None, [256], [0,256])
+  hist_size = len(hist)
+
+  accumulator = []
+  accumulator.append(float(hist[0][0]))
+  for i in range(1, hist_size):
+    accumulator.append(accumulator[i -1] + float(hist[i][0]))
+
+  n_px = accumulator[-1]
+  clip_thresh = n_px * (threshold / 100) / 2
+
+  minimum_gray = 0
+  while accumulator[minimum_gray] < clip_thresh:
+    minimum_gray += 1
+
+  maximum_gray = hist_size -1
+  while accumulator[maximum_gray] >= (n_px - clip_thresh):
+    maximum_gray -= 1
+
+  alpha = 255 / (maximum_gray - minimum_gray)
+  beta = -minimum_gray * alpha
+
+  img = img * alpha + beta
+  img[img < 0] = 0
+  img[img > 255] = 255
+  return img.astype(np.uint8)
+
+def measure(fn, img, repeat):
+  times = []
+  peak = 0
+  for _ in range(repeat):
+    src = img.copy()
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = fn(src, 3)
+    times.append(time.perf_counter() - start)
+    peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+  return out, sorted(times)[len(times) // 2], peak
+
+def main():
+  folder = Path(sys.argv[1]) if len(sys.argv) > 1 else Path('imgs')
+  repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+  for path in sorted(folder.glob('*.jp*g')):
+    img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if img is None:
+      continue
+    old, old_t, old_mem = measure(reference, img, repeat)
+    new, new_t, new_mem = measure(gain_and_bias_correction, img, repeat)
+    diff = int(np.abs(old.astype(np.int16) - new.astype(np.int16)).max())
+
+    h, w = img.shape[:2]
+    print(f'{path.name} ({w}x{h})')
+    print(f'  originale: {old_t * 1000:8.1f} ms  picco {old_mem / 2**20:8.1f} MiB')
+    print(f'  LUT:       {new_t * 1000:8.1f} ms  picco {new_mem / 2**20:8.1f} MiB')
+    print(f'  differenza massima: {diff} livelli di grigio')
+
+if __name__ == '__main__':
+  main()
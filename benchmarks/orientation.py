@@ -0,0 +1,47 @@
+# Verifica di app/orientation.py sulle foto di esempio: ogni immagine della
+# cartella (di default imgs/, foto di scontrini dritti) viene analizzata
+# dritta e capovolta, a più scale, e per ognuna si riportano angolo stimato
+# e confidenza. Una stima sbagliata sopra la confidenza minima farebbe
+# leggere lo scontrino al contrario senza rilettura: in quel caso lo script
+# esce con codice 1.
+#
+# Uso, dalla root del repository:
+#   python benchmarks/orientation.py [cartella immagini] [confidenza minima]
+
+import importlib.util
+import sys
+from pathlib import Path
+import cv2
+
+# carichiamo solo il modulo, senza importare il pacchetto app (che richiede flask e torch)
+spec = importlib.util.spec_from_file_location(
+  'orientation', Path(__file__).resolve().parent.parent / 'app' / 'orientation.py')
+orientation = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(orientation)
+
+SCALES = (1, 3, 6)
+
+def main():
+  root = Path(__file__).resolve().parent.parent
+  folder = Path(sys.argv[1]) if len(sys.argv) > 1 else root / 'imgs'
+  min_confidence = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+
+  total = confident = wrong = 0
+  for path in sorted(folder.glob('*.jp*g')):
+    img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    for scale in SCALES:
+      scaled = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+      for expected, candidate in ((0, scaled), (180, cv2.rotate(scaled, cv2.ROTATE_180))):
+        angle, confidence = orientation.detect_orientation(candidate)
+        total += 1
+        if confidence >= min_confidence:
+          confident += 1
+          wrong += angle != expected
+        status = 'ok' if angle == expected else 'SBAGLIATA'
+        print(f'{path.name} x{scale} {expected:>3}°: stima {angle:>3}° confidenza {confidence:.3f} {status}')
+
+  print(f'\n{total} stime, {confident} sopra la confidenza minima {min_confidence}, {wrong} sbagliate tra queste')
+  sys.exit(1 if wrong else 0)
+
+if __name__ == '__main__':
+  main()
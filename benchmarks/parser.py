@@ -0,0 +1,267 @@
+# Micro-benchmark di app/parser.py: confronta parse_ocr_result con
+# l'implementazione originale (riportata sotto come 'reference') su token
+# realistici e su token generati a caso, verifica che i risultati coincidano
+# con quelli attesi e misura il tempo per scontrino.
+#
+# Uso, dalla root del repository:
+#   python benchmarks/parser.py [ripetizioni]
+#
+# Differenze attese rispetto all'originale: il pattern '%d %m-%Y' ora viene
+# riconosciuto (prima era un duplicato del primo e non scattava mai) e la
+# lettura si ferma quando tutti i campi sono stati trovati. Con fixed=True
+# l'originale riproduce solo queste due correzioni, ed è il risultato atteso.
+
+import importlib.util
+import random
+import re
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+# carichiamo solo il modulo, senza importare il pacchetto app (che richiede flask e torch)
+spec = importlib.util.spec_from_file_location(
+  'parser', Path(__file__).resolve().parent.parent / 'app' / 'parser.py')
+parser = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(parser)
+
+# implementazione originale
+
+def reference(lst, fixed=False):
+  j = 1
+  res = {}
+  current_rep = None
+  l = len(lst)
+  while j <= l:
+    if fixed and len(res) == len(parser.FIELDS):
+      break
+    i = j-1
+    word = lst[i].lower()
+    # sistemiamo gli spazi, in modo che ce ne sia solo uno tra una parola e l'altra
+    word = ' '.join(word.split())
+    nxt = None
+    if j != l:
+      nxt = lst[j]
+    
+    if is_like(word, 'reparto totale'):
+      if nxt:
+        n = parse_float(nxt)
+        res['totale'] = n
+        j += 1
+        continue
+
+    elif is_like(word, 'reparto'):
+      # potrebbe essere 'reparto totale'
+      if nxt and is_like(' '.join(nxt.lower().split()), 'totale'):
+        if j+1 < l:
+          nxt = lst[j+1]
+          n = parse_float(nxt)
+          res['totale'] = n
+          j += 2
+          continue
+      else:
+        n = get_rep(word, nxt)
+        if n > 0:
+          current_rep = n
+          j += 1
+          continue
+        elif current_rep:
+          # non è stato riconosciuto il numero del reparto. Se è stato letto almeno un reparto,
+          # proviamo a indovinare che il reparto corrente è il successivo all'ultimo letto
+          current_rep += 1
+          j += 1
+          continue 
+
+    elif is_like(word, 'quantita'):
+      if nxt:
+        n = parse_int(nxt)
+        if current_rep and n > 0:
+          res[f'quantita{current_rep}'] = n
+          j += 1
+          continue
+
+    elif is_like(word, 'totale'):
+      if nxt:
+        n = parse_float(nxt)
+        if current_rep and n > 0:
+          res[f'reparto{current_rep}'] = n
+          j += 1
+          continue
+
+    elif is_like(word, 'pezzi'):
+      if nxt:
+        n = parse_int(nxt)
+        if n > 0:
+          res['quantita_totale'] = n
+          j += 1
+          continue
+
+    is_date = False
+    # cerca un pattern "<due cifre>-<due cifre>-<almeno quattro cifre>"
+    # che potrebbe indicare una data
+    match = re.match(r"\b\d{2}-\d{2}-\d{4,}\b", word)
+    if match:
+      # se ho matchato anche l'orario, prendo solo la parte con la data
+      match = match.group(0)[:10]
+      try:
+        date = datetime.strptime(match, '%d-%m-%Y')
+        res['data'] = date.strftime('%Y-%m-%d')
+        is_date = True
+      except ValueError:
+        pass
+
+    if not is_date:    
+        # proviamo il pattern "<due cifre> <due cifre> <almeno quattro cifre>"
+        match = re.match(r"\b\d{2}\s\d{2}\s\d{4,}\b", word)
+        if match:
+          match = match.group(0)[:10]
+          try:
+            date = datetime.strptime(match, '%d %m %Y')
+            res['data'] = date.strftime('%Y-%m-%d')
+            is_date = True
+          except ValueError:
+            pass
+
+    if not is_date:
+        # proviamo il pattern "<due cifre>-<due cifre> <almeno quattro cifre>"
+        match = re.match(r"\b\d{2}-\d{2}\s\d{4,}\b", word)
+        if match:
+          match = match.group(0)[:10]
+          try:
+            date = datetime.strptime(match, '%d-%m %Y')
+            res['data'] = date.strftime('%Y-%m-%d')
+            is_date = True
+          except ValueError:
+            pass
+              
+    if not is_date:
+        # infine il pattern "<due cifre> <due cifre>-<almeno quattro cifre>"
+        match = re.match(r"\b\d{2}\s\d{2}-\d{4,}\b" if fixed else r"\b\d{2}-\d{2}-\d{4,}\b", word)
+        if match:
+          match = match.group(0)[:10]
+          try:
+            date = datetime.strptime(match, '%d %m-%Y')
+            res['data'] = date.strftime('%Y-%m-%d')
+          except ValueError:
+            pass
+
+    j += 1
+  return res
+
+def is_like(word, target):
+  match = 0
+  l = min(len(word), len(target))
+  for i in range(l):
+    if word[i] == target[i]:
+      match += 1
+  return match / len(target) >= 0.6
+
+# ottiene il numero del reparto che si sta leggendo
+# controllando sia la parola stessa ('reparto n') sia la successiva
+# (in caso di situazioni tipo 'reparto' 'n'). Se fallisce, ritorna 0
+def get_rep(word, nxt):
+  rep = 0
+  try:
+    rep = int(word[-1])
+  except ValueError:
+    if nxt:
+      try:
+        rep = int(nxt)
+      except ValueError:
+        pass
+  
+  if rep > 5:
+    rep = 0
+  
+  return rep
+
+def parse_int(word):
+  word = word.replace(' ', '')
+  # i leading 0 sono quasi sicuramente 8
+  if len(word) > 1 and word[0] == '0':
+    word = '8' + word[1:]
+  try:
+    n = int(word)
+    return n
+  except ValueError:
+    return 0
+
+def parse_float(word):
+  word = word.replace(' ', '').replace(',', '.')
+  # il leading 0 non seguito da virgola è quasi sicuramente un 8
+  if len(word) > 1 and word[0] == '0' and word[1] != '.':
+    word = '8' + word[1:]
+  try:
+    n = float(word)
+    return n
+  except ValueError:
+    return 0
+
+# token come li restituisce l'OCR su scontrini reali, con i tipici errori di lettura
+CASES = [
+  [ 'AZZERAMENTO REPARTI', 'REPARTO 1', 'QUANTITA', '12', 'TOTALE', '45,60',
+    'REPARTO 2', 'QUANTITA', '3', 'TOTALE', '12,00', 'REPARTO 3', 'QUANTITA', '0',
+    'TOTALE', '0,00', 'REPARTO 4', 'QUANTITA', '7', 'TOTALE', '31,50',
+    'REPARTO 5', 'QUANTITA', '1', 'TOTALE', '4,00', 'REPARTO TOTALE', '93,10',
+    'PEZZI', '23', '11-05-2024 18:32', 'DOCUMENTO GESTIONALE' ],
+  [ 'AZZERAMENTO', 'REPARTI', 'REPART0', '1', 'Quantità', '05', 'T0TALE', '058,20',
+    'REPARTO', '2', 'QUANT1TA', '4', 'TOTALE', '16,40', 'REPARTO', 'QUANTITA', '2',
+    'TOTALE', '9,00', 'REPARTO', 'TOTALE', '83,60', 'N. PEZZI', '11',
+    '13 05 2024', 'DOCUMENTO GESTIONALE N. 12' ],
+  [ 'REPARTO 1', 'QUANTITA', '10', 'TOTALE', '25,00', 'REPARTO TOTALE', '25,00',
+    'PEZZI', '10', '18-05 2024 09:12' ],
+  [ 'ELLANOIZETSEG OTNEMUCOD', '4202-50-11', '32', 'IZZEP', '01,39',
+    'ELATOT OTRAPER', '00,4', 'ELATOT', '1', 'ATITNAUQ' ],
+  [ 'REPARTO 2', 'QUANTITA', '', 'TOTALE', '', 'REPARTO', '3', 'TOTALE', '7 ,50',
+    'PEZZI', 'l2', '20 05-2024' ],
+  []
+]
+
+VOCABULARY = [ 'REPARTO', 'REPARTO 1', 'REPARTO 3', 'REPARTO 9', 'REPARTO TOTALE', 'QUANTITA',
+               'Quantità', 'TOTALE', 'TOTALE EURO', 'PEZZI', 'N. PEZZI', 'AZZERAMENTO',
+               '12', '0', '05', '3,50', '058,20', '1.234,00', '', '11-05-2024', '11 05 2024 10:00',
+               '11-05 2024', '32-13-2024', 'DOCUMENTO', 'GESTIONALE', 'CASSA 1' ]
+
+def mutate(token):
+  if token and random.random() < 0.2:
+    i = random.randrange(len(token))
+    token = token[:i] + random.choice('0O1lI8B ') + token[i+1:]
+  return token
+
+def random_case():
+  return [ mutate(random.choice(VOCABULARY)) for _ in range(random.randint(0, 60)) ]
+
+# il nuovo parser deve dare esattamente il risultato dell'originale con le
+# sole correzioni attese
+def same(case, new):
+  return new == reference(case, fixed=True)
+
+def timeit(fn, cases, repeat):
+  start = time.perf_counter()
+  for _ in range(repeat):
+    for case in cases:
+      fn(case)
+  return (time.perf_counter() - start) / (repeat * len(cases))
+
+def main():
+  repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+  for case in CASES:
+    old, new = reference(case), parser.parse_ocr_result(case)
+    if old != new:
+      label = 'differenza attesa' if same(case, new) else 'DIFFERENZA'
+      print(f'{label}:', case, old, new, sep='\n  ')
+
+  random.seed(0)
+  fuzz = [ random_case() for _ in range(5000) ]
+  mismatches = [ case for case in fuzz
+                 if not same(case, parser.parse_ocr_result(case)) ]
+  print(f'{len(CASES)} casi reali, {len(fuzz)} casi casuali, {len(mismatches)} differenze inattese')
+
+  old_t = timeit(reference, CASES, repeat)
+  new_t = timeit(parser.parse_ocr_result, CASES, repeat)
+  print(f'originale: {old_t * 1e6:8.1f} µs per scontrino')
+  print(f'nuovo:     {new_t * 1e6:8.1f} µs per scontrino ({old_t / new_t:.1f}x)')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,82 @@
+# Taratura delle soglie OCR_QUALITY_*: misura nitidezza, luminosità,
+# contrasto, area e inclinazione (ocr.measure_quality, sulla stessa copia a
+# 500 px del controllo di qualità) sulle foto leggibili della cartella, a
+# più scale e ricompresse in JPEG come i fotogrammi della fotocamera, e su
+# versioni rovinate apposta: buie, sovraesposte, slavate, mosse, uniformi.
+# Per ogni misura riporta il peggior valore tra le foto leggibili e il
+# migliore tra quelle rovinate: le soglie vanno scelte in mezzo. Esce con
+# codice 1 se la configurazione attuale scarta una foto leggibile.
+#
+# Uso, dalla root del repository:
+#   python benchmarks/quality.py [cartella immagini]
+
+import sys
+from pathlib import Path
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from app import create_app
+from app.ocr import small_gray, find_roi, gain_lut, measure_quality, quality_problem
+
+SCALES = (0.5, 1, 2, 4)
+
+# la foto come arriverebbe dalla fotocamera: ridimensionata e ricompressa
+def variants(img):
+  for scale in SCALES:
+    scaled = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+    for quality in (90, 70):
+      data = cv2.imencode('.jpg', scaled, [ cv2.IMWRITE_JPEG_QUALITY, quality ])[1]
+      yield f'x{scale} q{quality}', cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+
+def degraded(img):
+  f = img.astype(np.float32)
+  yield 'buia', np.clip(f * 0.15, 0, 255).astype(np.uint8), 'dark'
+  yield 'sovraesposta', np.clip(f * 0.1 + 235, 0, 255).astype(np.uint8), 'bright'
+  yield 'slavata', np.clip((f - f.mean()) * 0.3 + f.mean(), 0, 255).astype(np.uint8), 'contrast'
+  yield 'mossa', cv2.GaussianBlur(img, (0, 0), 0.015 * max(img.shape)), 'sharpness'
+  yield 'uniforme', np.full_like(img, 128), 'contrast'
+
+def measure(img):
+  small, ratio = small_gray(img)
+  _, _, cnt = find_roi(cv2.LUT(small, gain_lut(small, 3)), ratio)
+  return measure_quality(small, cnt)
+
+def main():
+  root = Path(__file__).resolve().parent.parent
+  folder = Path(sys.argv[1]) if len(sys.argv) > 1 else root / 'imgs'
+  app = create_app()
+
+  good = []
+  bad = []
+  rejected = 0
+  with app.app_context():
+    for path in sorted(folder.glob('*.jp*g')):
+      img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+      for name, variant in variants(img):
+        quality = measure(variant)
+        reason = quality_problem(quality)
+        rejected += reason is not None
+        good.append(quality)
+        print(f'{path.name} {name}: ' + ' '.join(f'{k} {v:.1f}' for k, v in quality.items()) + (f' SCARTATA ({reason})' if reason else ''))
+      for name, variant, expected in degraded(img):
+        quality = measure(variant)
+        reason = quality_problem(quality)
+        bad.append((expected, quality))
+        print(f'{path.name} {name}: ' + ' '.join(f'{k} {v:.1f}' for k, v in quality.items()) + f' -> {reason or "ACCETTATA"}')
+
+  print('\nmisura        peggiore leggibile  migliore rovinata')
+  for key, low, expected in (('brightness', True, 'dark'), ('brightness', False, 'bright'),
+                             ('contrast', True, 'contrast'), ('sharpness', True, 'sharpness')):
+    worst = (min if low else max)(q[key] for q in good)
+    best = [ q[key] for e, q in bad if e == expected ]
+    best = (max if low else min)(best) if best else float('nan')
+    print(f"{key + (' min' if low else ' max'):<14}{worst:>18.1f}{best:>19.1f}")
+  print(f"{'area min':<14}{min(q['area'] for q in good):>18.3f}")
+  print(f"{'skew max':<14}{max(q['skew'] for q in good):>18.1f}")
+
+  print(f'\n{len(good)} foto leggibili, {rejected} scartate con la configurazione attuale')
+  sys.exit(1 if rejected else 0)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,67 @@
+# Misura la memoria di N worker che leggono scontrini nelle due modalità
+# senza processo dedicato: ogni worker carica il proprio modello, oppure il
+# modello viene precaricato nel padre prima del fork (OCR_PRELOAD, come
+# gunicorn --preload). Ogni worker esegue una lettura a vuoto e, quando
+# tutti sono pronti, riporta RSS e PSS da /proc/self/smaps_rollup (vedi
+# inference.memory): il PSS divide le pagine condivise tra i processi che le
+# usano, quindi va letto con tutti i worker vivi. Per il processo dedicato
+# (OCR_INFERENCE_ADDRESS) si confrontano invece /ocr/health dei worker e la
+# memoria di 'flask ocr serve-model'.
+#
+# Uso, dalla root del repository (solo Linux, con la configurazione di instance/):
+#   python benchmarks/worker_memory.py [worker]
+
+import multiprocessing
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from app import create_app, inference
+
+def worker(ready, done, conn):
+  inference.warm_up()
+  ready.wait()
+  conn.send({ **inference.memory(), 'error': inference.status().get('error') })
+  done.wait()
+
+# avvia i worker con fork e ritorna le loro misure, prese insieme
+def measure(workers):
+  ctx = multiprocessing.get_context('fork')
+  ready = ctx.Barrier(workers)
+  done = ctx.Barrier(workers + 1)
+  pipes = [ ctx.Pipe() for _ in range(workers) ]
+  procs = [ ctx.Process(target=worker, args=(ready, done, child)) for _, child in pipes ]
+  for p in procs:
+    p.start()
+  results = [ parent.recv() for parent, _ in pipes ]
+  done.wait()
+  for p in procs:
+    p.join()
+  return results
+
+def report(name, results):
+  print(f'\n{name}')
+  for r in results:
+    if r.get('error'):
+      print(f"  pid {r['pid']}: errore {r['error']}")
+    else:
+      print(f"  pid {r['pid']}: RSS {r.get('rss_mb', 0):.0f} MB, PSS {r.get('pss_mb', 0):.0f} MB")
+  pss = sum(r.get('pss_mb', 0) for r in results)
+  print(f'  PSS totale {pss:.0f} MB, {pss / len(results):.0f} MB per worker')
+
+def main():
+  workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+  app = create_app()
+  with app.app_context():
+    if app.config['OCR_PRELOAD'] or app.config['OCR_WARMUP']:
+      sys.exit('Disattiva OCR_PRELOAD e OCR_WARMUP: il padre non deve caricare il modello prima della prima misura.')
+    if inference.primary_device() != 'cpu':
+      sys.exit('Il confronto ha senso solo con l\'inferenza su CPU (OCR_DEVICE=\'cpu\', senza OCR_INFERENCE_ADDRESS).')
+
+    # prima senza precaricamento: il padre non deve aver ancora caricato il modello
+    report('modello caricato da ogni worker', measure(workers))
+    inference.preload()
+    report(f"modello precaricato nel padre (PSS del padre {inference.memory().get('pss_mb', 0):.0f} MB)", measure(workers))
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,139 @@
 SECRET_KEY='dev'
 #SQLALCHEMY_ECHO=True
 SQLALCHEMY_DATABASE_URI='sqlite:///app.sqlite' # relativo all'instance folder
-PYTORCH_CUDA_ALLOC_CONF='expandable_segments:True'
\ No newline at end of file
+PYTORCH_CUDA_ALLOC_CONF='expandable_segments:True'
+
+# lettura OCR asincrona: l'upload ritorna subito l'id del lavoro e un pool
+# di OCR_WORKERS thread esegue la pipeline. Oltre OCR_MAX_PENDING lavori
+# in attesa le richieste vengono rifiutate con 503
+OCR_ASYNC=False
+OCR_WORKERS=2
+OCR_MAX_PENDING=20
+OCR_JOB_TTL=300 # secondi per cui un risultato resta consultabile
+
+# lingue del modello EasyOCR, caricato al primo utilizzo. Con OCR_WARMUP il
+# caricamento e un'inferenza di prova partono in background all'avvio
+OCR_LANGS=['it']
+OCR_WARMUP=False
+
+# legge tutti i ritagli candidati (dritti e capovolti) in un'unica inferenza
+# batch invece che in sequenza
+OCR_BATCH_CANDIDATES=False
+
+# stima dritto/capovolto prima della lettura; sotto la confidenza minima si
+# rilegge comunque l'immagine capovolta come prima
+OCR_ORIENTATION_DETECTION=False
+OCR_ORIENTATION_MIN_CONFIDENCE=0.1
+
+# preprocessing in scala di grigi con analisi su un'unica copia ridotta;
+# False ripristina la pipeline a colori a piena risoluzione. Con
+# OCR_DECODE_REDUCTION 2, 4 o 8 il JPEG viene decodificato già ridotto
+OCR_FUSED_PREPROCESSING=True
+OCR_DECODE_REDUCTION=1
+
+# cache dei risultati OCR indicizzata sull'hash della foto (0 la disattiva).
+# Con OCR_CACHE_PERSIST viene salvata in instance/ocr-cache.json
+OCR_CACHE_SIZE=256
+OCR_CACHE_TTL=86400 # secondi
+OCR_CACHE_PERSIST=False
+
+# frazione delle richieste OCR da profilare ('cprofile' o 'torch'); i
+# profili vengono salvati in instance/profiles
+OCR_PROFILE_SAMPLE_RATE=0
+OCR_PROFILE_MODE='cprofile'
+
+# dispositivo per l'inferenza: 'auto' (GPU se presente), 'cuda' o 'cpu'.
+# Le inferenze contemporanee sulla GPU sono limitate dalla memoria libera
+# (OCR_GPU_MB_PER_INFERENCE) e da OCR_GPU_MAX_CONCURRENCY (0 = nessun
+# limite aggiuntivo). Con OCR_CPU_FALLBACK, se la GPU resta occupata più di
+# OCR_GPU_QUEUE_TIMEOUT secondi o esaurisce la memoria, si legge con la CPU
+OCR_DEVICE='auto'
+OCR_GPU_MB_PER_INFERENCE=1500
+OCR_GPU_MAX_CONCURRENCY=0
+OCR_GPU_QUEUE_TIMEOUT=2.0
+OCR_CPU_FALLBACK=True
+
+# micro-batching tra richieste: le letture che arrivano entro
+# OCR_MICROBATCH_WINDOW secondi (al massimo OCR_MICROBATCH_MAX) vengono
+# eseguite insieme in un'unica inferenza batch. Nello stesso batch vanno
+# solo immagini che il bordo comune allunga al massimo di
+# OCR_MICROBATCH_MAX_PADDING volte per lato
+OCR_MICROBATCH=False
+OCR_MICROBATCH_WINDOW=0.03
+OCR_MICROBATCH_MAX=8
+OCR_MICROBATCH_MAX_PADDING=1.25
+
+# backend per la lettura con la CPU: 'torch' (easyocr con le impostazioni
+# predefinite, riferimento nel benchmark) o 'cpu' (gli stessi modelli, con
+# OCR_CPU_THREADS thread di torch, 0 = default, e con OCR_ONNX e onnxruntime
+# installato, pip install app[onnx], il rilevatore eseguito con onnxruntime)
+OCR_BACKEND='cpu'
+OCR_CPU_THREADS=0
+OCR_ONNX=False
+
+# deploy con più worker: OCR_PRELOAD carica il modello in create_app, prima
+# del fork (gunicorn --preload, solo CPU). Con OCR_INFERENCE_ADDRESS
+# (socket Unix o host:porta su loopback) i worker usano il processo avviato
+# con 'flask ocr serve-model' e non caricano il modello. OCR_INFERENCE_AUTHKEY
+# è obbligatoria in quel caso: una chiave casuale di almeno 16 caratteri
+OCR_PRELOAD=False
+OCR_INFERENCE_ADDRESS=None
+OCR_INFERENCE_AUTHKEY=None
+
+# la pipeline si ferma appena data, totali e reparti letti tornano tra loro,
+# senza leggere il capovolto o il ritaglio di fallback se non servono
+OCR_EARLY_EXIT=True
+
+# rilettura mirata: se mancano dei campi, o il valore è stato letto con
+# confidenza inferiore a OCR_FIELD_REPAIR_MIN_CONFIDENCE, si rilegge solo la
+# regione accanto alla parola chiave, ingrandita OCR_FIELD_REPAIR_SCALE volte
+OCR_FIELD_REPAIR=False
+OCR_FIELD_REPAIR_MIN_CONFIDENCE=0.5
+OCR_FIELD_REPAIR_SCALE=2
+
+# OCR_FIELD_PROFILES: la rilettura mirata usa per importi e quantità solo
+# cifre e separatori. OCR_FIELD_CONFIDENCE: la risposta di /ocr/ contiene
+# anche la confidenza di ogni campo ('confidenza'), usata dal form
+OCR_FIELD_PROFILES=True
+OCR_FIELD_CONFIDENCE=True
+
+# modelli di layout per cassa: dalle letture complete si impara la posizione
+# dei campi sullo scontrino (salvata in instance/ocr-layouts.json). Dopo
+# OCR_LAYOUT_MIN_SAMPLES letture, le foto con firma del layout simile almeno
+# OCR_LAYOUT_MIN_SCORE vengono lette senza il rilevamento del testo
+OCR_LAYOUTS=False
+OCR_LAYOUT_MIN_SCORE=0.9
+OCR_LAYOUT_MIN_SAMPLES=3
+
+# lettura a strisce: gli scontrini raddrizzati più alti di OCR_TILE_HEIGHT +
+# OCR_TILE_OVERLAP pixel vengono letti in strisce alte OCR_TILE_HEIGHT,
+# sovrapposte di almeno OCR_TILE_OVERLAP (più di una riga di testo)
+OCR_TILING=False
+OCR_TILE_HEIGHT=1280
+OCR_TILE_OVERLAP=128
+
+# controllo di qualità: le foto sfocate, scure, sovraesposte, con poco
+# contrasto, con lo scontrino troppo piccolo o troppo inclinato vengono
+# scartate subito con un messaggio per l'operatore. Le misure sono prese
+# sulla copia a 500 px in scala di grigi. Le soglie sono scelte con
+# benchmarks/quality.py, a metà strada tra il peggior valore delle foto di
+# imgs/ (a più scale e ricompresse) e il migliore delle loro versioni
+# rovinate: nitidezza 99 contro 1.5 della foto mossa, luminosità 180 contro
+# 26 della buia e 252 della sovraesposta, contrasto 18 contro 6 della
+# slavata. Con nuove foto di esempio vanno ricontrollate con lo script e
+# con 'flask ocr bench', che mostra le misure delle letture complete e non
+OCR_QUALITY_GATE=False
+OCR_QUALITY_MIN_SHARPNESS=15
+OCR_QUALITY_MIN_BRIGHTNESS=40
+OCR_QUALITY_MAX_BRIGHTNESS=235
+OCR_QUALITY_MIN_CONTRAST=10
+OCR_QUALITY_MIN_AREA=0.1
+OCR_QUALITY_MAX_SKEW=30
+
+# /ocr/batch: foto lette in parallelo, numero massimo di foto per richiesta,
+# dimensione massima di una foto (estratta dall'archivio zip) e di tutte le
+# foto della richiesta insieme
+OCR_BATCH_WORKERS=4
+OCR_BATCH_MAX_IMAGES=50
+OCR_BATCH_MAX_IMAGE_BYTES=20 * 1024 * 1024
+OCR_BATCH_MAX_TOTAL_BYTES=200 * 1024 * 1024